@@ -1,12 +1,27 @@
 import os
+import copy
+import hashlib
 import json
+import queue
+import re
+import threading
 import time
+from concurrent.futures import Future
 from dataclasses import dataclass, field
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
 from pathlib import Path
 
 import streamlit as st
+import streamlit.components.v1 as components
+import chat_context
 import db
+import llm
+import pdf_index
+import persistence
+import prefetch
+import ratelimit
+import response_cache
+import usage
 
 try:
     from dotenv import load_dotenv
@@ -15,7 +30,20 @@ except Exception:
     pass
 
 NEXT_LEVEL_XP = 100
-STATE_FILE = Path(__file__).with_name("state_store.json")
+# Render tutor replies as they stream in instead of behind a spinner.
+STREAM_REPLIES = os.getenv("TUTORQUEST_STREAM_REPLIES", "1") != "0"
+# "passages" sends only the curriculum excerpts relevant to each turn; "full" attaches the whole PDF.
+PDF_CONTEXT_MODE = os.getenv("TUTORQUEST_PDF_CONTEXT", "passages")
+# Generate likely next replies (Direct "Continue", Narrative "Next Episode") before they're asked for.
+PREFETCH_REPLIES = os.getenv("TUTORQUEST_PREFETCH", "1") != "0"
+# Browser cookie carrying the remember-me session token.
+SESSION_COOKIE = "tutorquest_session"
+# Only set behind a reverse proxy that overwrites X-Forwarded-For; otherwise clients could pick their own rate-limit bucket.
+TRUST_PROXY_HEADERS = os.getenv("TUTORQUEST_TRUST_PROXY_HEADERS", "0") == "1"
+# Show persistence counters in the sidebar, for operators tuning the app.
+SHOW_METRICS = os.getenv("TUTORQUEST_SHOW_METRICS", "0") == "1"
+# Messages restored at login; older history is fetched a page at a time on demand.
+HISTORY_PAGE_SIZE = 40
 
 LEARNING_CONCEPTS = [
     {
@@ -126,27 +154,116 @@ TOPIC_KEYWORDS = {
 }
 
 
-def load_persisted_state() -> Dict:
-    try:
-        if STATE_FILE.exists():
-            with STATE_FILE.open("r", encoding="utf-8") as f:
-                data = json.load(f)
-                if isinstance(data, dict):
-                    return data
-    except Exception:
-        pass
-    return {}
+def mark_messages_changed(from_idx: int):
+    """Flag messages from from_idx onwards as rewritten so the next save replaces their rows."""
+    dirty_from = st.session_state.get("messages_dirty_from")
+    if dirty_from is None or from_idx < dirty_from:
+        st.session_state.messages_dirty_from = from_idx
 
 
-def save_persisted_state():
-    messages_payload = []
-    for msg in st.session_state.get("messages", []):
+def collect_message_log_changes(messages: List["Message"]) -> Optional[Tuple[int, List[Dict]]]:
+    """Return the (start_seq, message payloads) slice that changed since the last sync, if any."""
+    synced = st.session_state.get("messages_synced")
+    if synced is None:
+        # History for this user has not been loaded yet; syncing now could clobber it.
+        return None
+    dirty_from = st.session_state.get("messages_dirty_from")
+    start = min(synced, len(messages))
+    if dirty_from is not None:
+        start = min(start, dirty_from)
+    if start == len(messages) == synced:
+        return None
+    st.session_state.messages_synced = len(messages)
+    st.session_state.messages_dirty_from = None
+    # Only the changed tail is copied, so the cost doesn't grow with the length of the history.
+    payloads = [
+        {"role": msg.role, "content": msg.content, "metadata": copy.deepcopy(msg.metadata)}
+        for msg in messages[start:]
+        if isinstance(msg, Message)
+    ]
+    # Only the newest page may be loaded; older messages keep their sequence numbers.
+    return st.session_state.get("messages_offset", 0) + start, payloads
+
+
+def load_older_messages():
+    """Prepend the previous page of persisted history to the loaded messages."""
+    offset = st.session_state.get("messages_offset", 0)
+    user_id = st.session_state.get("user_id")
+    if not user_id or offset <= 0:
+        return
+    page = db.get_messages(user_id, limit=HISTORY_PAGE_SIZE, before_seq=offset)
+    if not page:
+        st.session_state.messages_offset = 0
+        return
+    older = [Message(role=m["role"], content=m["content"], metadata=m["metadata"]) for m in page]
+    st.session_state.messages = older + st.session_state.messages
+    st.session_state.messages_offset = page[0]["seq"]
+    if st.session_state.get("messages_synced") is not None:
+        st.session_state.messages_synced += len(older)
+    if st.session_state.get("messages_dirty_from") is not None:
+        st.session_state.messages_dirty_from += len(older)
+
+
+def full_transcript() -> List[Dict]:
+    """Every message for export, including pages that haven't been loaded into the session."""
+    transcript = []
+    offset = st.session_state.get("messages_offset", 0)
+    user_id = st.session_state.get("user_id")
+    if user_id and offset > 0:
+        transcript.extend(
+            {"role": m["role"], "content": m["content"]}
+            for m in db.get_messages(user_id, before_seq=offset)
+        )
+    for msg in st.session_state.messages:
         if isinstance(msg, Message):
-            messages_payload.append({
-                "role": msg.role,
-                "content": msg.content,
-                "metadata": msg.metadata,
-            })
+            transcript.append({"role": msg.role, "content": msg.content})
+        elif isinstance(msg, dict):
+            transcript.append({"role": msg.get("role", "unknown"), "content": msg.get("content", "")})
+    return transcript
+
+
+def collect_progress_changes() -> Dict:
+    """Return the progress and bandit rows that differ from what was last written."""
+    synced = st.session_state.get("progress_synced")
+    if synced is None:
+        return {}
+    current = db.flatten_progress({
+        "concept_progress": st.session_state.get("concept_progress", {}),
+        "subtopic_progress": st.session_state.get("subtopic_progress", {}),
+        "learning_point_progress": st.session_state.get("learning_point_progress", {}),
+        "bandit_stats": st.session_state.get("bandit_stats", {}),
+    })
+    changes = {key: value for key, value in current.items() if synced.get(key) != value}
+    if changes:
+        synced.update(changes)
+    return changes
+
+
+def mark_state_dirty():
+    """Record that persisted state changed; the write happens once in flush_persisted_state()."""
+    stats = st.session_state.setdefault("persist_stats", {"marks": 0, "flushes": 0})
+    stats["marks"] += 1
+    st.session_state.state_dirty = True
+
+
+def get_persist_stats() -> Dict:
+    """How many saves were requested vs. actually written this session."""
+    stats = st.session_state.get("persist_stats", {"marks": 0, "flushes": 0})
+    return {
+        "marks": stats["marks"],
+        "flushes": stats["flushes"],
+        "flushes_saved": max(stats["marks"] - stats["flushes"], 0),
+    }
+
+
+def flush_persisted_state():
+    """Write state to disk and the DB if anything was marked dirty during this run."""
+    if not st.session_state.get("state_dirty"):
+        return
+    st.session_state.state_dirty = False
+    stats = st.session_state.setdefault("persist_stats", {"marks": 0, "flushes": 0})
+    stats["flushes"] += 1
+
     data = {
         "xp": st.session_state.get("xp", 0),
         "level": st.session_state.get("level", 1),
@@ -158,7 +275,6 @@ def save_persisted_state():
         "current_topic": st.session_state.get("current_topic"),
         "personality": st.session_state.get("personality"),
         "challenge_active": st.session_state.get("challenge_active", False),
-        "messages": messages_payload,
         "user_id": st.session_state.get("user_id"),
         "username": st.session_state.get("username"),
         "hint_policy": st.session_state.get("hint_policy", "LIGHT_HINTS"),
@@ -172,17 +288,29 @@ def save_persisted_state():
         "current_hint_policy": st.session_state.get("current_hint_policy"),
         "message_feedback": st.session_state.get("message_feedback", {}),
     }
+    user_id = st.session_state.get("user_id")
+    if not user_id:
+        return
     try:
-        with STATE_FILE.open("w", encoding="utf-8") as f:
-            json.dump(data, f)
+        # Snapshot on the script thread; the writer thread does the disk and SQLite work.
+        message_changes = collect_message_log_changes(st.session_state.get("messages", []))
+        progress_changes = collect_progress_changes()
+        xp_awards = st.session_state.get("pending_xp_awards") or []
+        st.session_state.pending_xp_awards = []
+        xp_update = None
+        if xp_awards or st.session_state.get("xp_column_stale"):
+            xp_update = (data["xp"], data["level"])
+            st.session_state.xp_column_stale = False
+        persistence.get_writer().submit(
+            user_id,
+            copy.deepcopy(data),
+            message_changes,
+            progress_changes,
+            xp=xp_update,
+            xp_awards=xp_awards,
+        )
     except Exception:
         st.warning("Unable to persist XP locally.")
-    try:
-        user_id = st.session_state.get("user_id")
-        if user_id:
-            db.save_user_state(user_id, data)
-    except Exception:
-        pass
 
 @dataclass
 class Message:
@@ -191,26 +319,14 @@ class Message:
     metadata: Optional[Dict] = None
 
 def init_state():
-    persisted = load_persisted_state()
-    persisted_xp = persisted.get("xp", 0)
-    computed_level = 1 + persisted_xp // NEXT_LEVEL_XP
-    
+    # Stored state is applied when the account loads in run_app(); these are a fresh session's defaults.
     default_subtopic_progress = {}
-    default_learning_point_progress = {}
     
     for subtopic in LEARNING_CONCEPTS[0]["subtopics"]:
         default_subtopic_progress[subtopic["key"]] = {
             "unlocked": subtopic.get("unlocked", False),
             "mastered": subtopic.get("mastered", False),
         }
-        default_learning_point_progress[subtopic["key"]] = {
-            "lp_0": "locked",
-            "lp_1": "locked",
-            "lp_2": "locked",
-            "lp_3": "locked",
-        }
-        if subtopic.get("unlocked"):
-            default_learning_point_progress[subtopic["key"]]["lp_0"] = "active"
     
     default_concept_progress = {
         concept["key"]: {
@@ -220,31 +336,6 @@ def init_state():
         for idx, concept in enumerate(LEARNING_CONCEPTS)
     }
     
-    persisted_concepts = persisted.get("concept_progress")
-    if isinstance(persisted_concepts, dict):
-        for key, entry in default_concept_progress.items():
-            stored = persisted_concepts.get(key)
-            if isinstance(stored, dict):
-                entry["unlocked"] = bool(stored.get("unlocked", entry["unlocked"]))
-                entry["mastered"] = bool(stored.get("mastered", entry["mastered"]))
-    
-    persisted_subtopics = persisted.get("subtopic_progress")
-    if isinstance(persisted_subtopics, dict):
-        for key, entry in default_subtopic_progress.items():
-            stored = persisted_subtopics.get(key)
-            if isinstance(stored, dict):
-                entry["unlocked"] = bool(stored.get("unlocked", entry["unlocked"]))
-                entry["mastered"] = bool(stored.get("mastered", entry["mastered"]))
-    
-    persisted_lp = persisted.get("learning_point_progress")
-    if isinstance(persisted_lp, dict):
-        for key, entry in default_learning_point_progress.items():
-            stored = persisted_lp.get(key)
-            if isinstance(stored, dict):
-                for lp_key in ["lp_0", "lp_1", "lp_2", "lp_3"]:
-                    if lp_key in stored:
-                        entry[lp_key] = stored[lp_key]
-    
     # Initialize default bandit stats with user feedback tracking
     default_bandit_stats = {
         "hint_policy_rewards": {"NO_AUTOMATIC_HINTS": [], "LIGHT_HINTS": [], "FULL_HINTS": []},
@@ -257,50 +348,63 @@ def init_state():
     
     defaults = {
         "page": "User Home",
-        "xp": persisted_xp,
-        "level": max(persisted.get("level", 1), computed_level),
+        "xp": 0,
+        "level": 1,
         "messages": [],
-        "personality": persisted.get("personality", "Socratic"),
+        "personality": "Socratic",
         "awaiting_answer": False,
         "question_type": None,
         "pdf_uploaded": False,
         "pdf_file_ref": None,
-        "current_topic": persisted.get("current_topic", "General Tutoring"),
+        "pdf_local_path": None,
+        "pdf_index_key": None,
+        "current_topic": "General Tutoring",
         "chat_session": None,
         "chat_session_personality": None,
         "chat_session_pdf_id": None,
-        "intro_sent": persisted.get("intro_sent", False),
-        "current_concept": persisted.get("current_concept", LEARNING_CONCEPTS[0]["key"]),
-        "current_subtopic": persisted.get("current_subtopic", "origins_expansion"),
+        "chat_session_digest": "",
+        "chat_turns": [],
+        "chat_summary": "",
+        "chat_context_tokens": 0,
+        "chat_system_tokens": 0,
+        "chat_summary_points_done": 0,
+        "chat_compactions": 0,
+        "intro_sent": False,
+        "current_concept": LEARNING_CONCEPTS[0]["key"],
+        "current_subtopic": "origins_expansion",
         "concept_progress": default_concept_progress,
         "subtopic_progress": default_subtopic_progress,
-        "learning_point_progress": persisted.get("learning_point_progress", {}),
+        "learning_point_progress": {},
         "community_pointer": 0,
-        "challenge_active": persisted.get("challenge_active", False),
+        "challenge_active": False,
         "topic_refresh_counter": 0,
         "editing_message_idx": None,
         "db_state_loaded": False,
+        "messages_synced": None,
+        "messages_offset": 0,
+        "progress_synced": None,
+        "messages_dirty_from": None,
         "quiz_score": 0,
         "quiz_total": 0,
         "quiz_mode": False,
-        "user_id": persisted.get("user_id"),
-        "username": persisted.get("username"),
+        "user_id": None,
+        "username": None,
         "message_count_for_lp_update": 0,
-        "hint_policy": persisted.get("hint_policy", "LIGHT_HINTS"),
-        "question_depth": persisted.get("question_depth", "DEEP_PROBE"),
-        "quiz_difficulty": persisted.get("quiz_difficulty", "MEDIUM"),
+        "hint_policy": "LIGHT_HINTS",
+        "question_depth": "DEEP_PROBE",
+        "quiz_difficulty": "MEDIUM",
         "last_question_time": None,
         "question_attempts": 0,
-        "bandit_stats": persisted.get("bandit_stats", default_bandit_stats),
+        "bandit_stats": default_bandit_stats,
         "turns_since_lp_check": 0,
-        "narrative_episode": persisted.get("narrative_episode", 1),
-        "narrative_episode_phase": persisted.get("narrative_episode_phase", "setup"),
-        "hint_given_this_question": persisted.get("hint_given_this_question", False),
-        "current_hint_policy": persisted.get("current_hint_policy"),
+        "narrative_episode": 1,
+        "narrative_episode_phase": "setup",
+        "hint_given_this_question": False,
+        "current_hint_policy": None,
         "just_awarded_xp": False,
         "pending_xp_context": None,
         # New: Track user feedback on messages (message_idx -> "up" or "down")
-        "message_feedback": persisted.get("message_feedback", {}),
+        "message_feedback": {},
         # New: Track the last question asked to avoid repeats
         "last_question_asked": None,
     }
@@ -326,27 +430,6 @@ def init_state():
     if topic in ("General Tutoring", None, "") and active_concept:
         st.session_state.current_topic = active_concept["title"]
 
-    persisted_messages = persisted.get("messages")
-    if (not st.session_state.get("messages")) and isinstance(persisted_messages, list) and persisted_messages:
-        restored = []
-        for payload in persisted_messages:
-            if not isinstance(payload, dict):
-                continue
-            role = payload.get("role")
-            content = payload.get("content")
-            if role and content is not None:
-                restored.append(
-                    Message(
-                        role=role,
-                        content=content,
-                        metadata=payload.get("metadata"),
-                    )
-                )
-        if restored:
-            st.session_state.messages = restored
-            st.session_state.awaiting_answer = False
-            st.session_state.question_type = None
-
 def level_progress(xp: int) -> float:
     return min((xp % NEXT_LEVEL_XP) / NEXT_LEVEL_XP, 1.0)
 
@@ -359,12 +442,15 @@ def award_xp(amount: int = 15, reason: str = "", skip_rerun: bool = False):
         st.session_state.level = new_level
         leveled_up = True
     
+    # Logged per award so the leaderboard can show weekly gains without parsing state.
+    st.session_state.setdefault("pending_xp_awards", []).append(amount)
+    
     # Show visible XP notification
     if reason:
         st.success(f"🌟 **+{amount} XP** earned: {reason}")
         st.toast(f"+{amount} XP: {reason}", icon="⭐")
     
-    save_persisted_state()
+    mark_state_dirty()
     
     if leveled_up:
         st.balloons()
@@ -373,39 +459,110 @@ def award_xp(amount: int = 15, reason: str = "", skip_rerun: bool = False):
     if not skip_rerun:
         st.rerun()
 
-_genai_import_error: Optional[str] = None
-try:
-    import google.generativeai as genai
-except Exception as e:
-    _genai_import_error = str(e)
-    genai = None
+def usage_context(flow: str, payload=None) -> Dict:
+    """Who is calling and what the prompt is made of, captured on the script thread for record_llm_usage()."""
+    context = {
+        "user_id": st.session_state.get("user_id"),
+        "personality": st.session_state.get("personality"),
+        "flow": flow,
+        "system_tokens_est": 0,
+        "history_tokens_est": 0,
+        "attachment_tokens_est": 0,
+        "message_tokens_est": 0,
+        "whole_pdf": False,
+    }
+    if payload is not None:
+        text = payload_text(payload)
+        system_tokens = st.session_state.get("chat_system_tokens", 0)
+        context["system_tokens_est"] = system_tokens
+        context["history_tokens_est"] = max(st.session_state.get("chat_context_tokens", 0) - system_tokens, 0)
+        message, _, excerpts = text.partition(EXCERPTS_MARKER)
+        context["message_tokens_est"] = chat_context.estimate_tokens(message)
+        context["attachment_tokens_est"] = chat_context.estimate_tokens(excerpts) if excerpts else 0
+        context["whole_pdf"] = isinstance(payload, list)
+    return context
+
+
+def record_llm_usage(context: Dict, kind: str, source: str, started: float, response=None,
+                     first_token_at: Optional[float] = None, ok: bool = True):
+    """Queue one usage row. Safe to call from worker threads: it doesn't touch st.session_state."""
+    wall_ms = (time.perf_counter() - started) * 1000
+    metadata = getattr(response, "usage_metadata", None)
+    prompt_tokens = getattr(metadata, "prompt_token_count", 0) or 0
+    response_tokens = getattr(metadata, "candidates_token_count", 0) or 0
+    attachment_tokens = context["attachment_tokens_est"]
+    if context["whole_pdf"] and prompt_tokens:
+        # The PDF is billed per page; whatever the text estimates don't account for is the file.
+        attachment_tokens = max(
+            prompt_tokens - context["system_tokens_est"] - context["history_tokens_est"] - context["message_tokens_est"], 0
+        )
+    if first_token_at is not None:
+        ttft_ms = (first_token_at - started) * 1000
+    else:
+        ttft_ms = wall_ms if kind != "upload" and source == "api" else None
+    usage.get_usage_recorder().record(
+        user_id=context["user_id"],
+        personality=context["personality"],
+        flow=context["flow"],
+        kind=kind,
+        source=source,
+        model=llm.MODEL_TIERS["default"] if kind != "upload" else None,
+        ok=int(ok),
+        wall_ms=wall_ms,
+        ttft_ms=ttft_ms,
+        prompt_tokens=prompt_tokens,
+        response_tokens=response_tokens,
+        system_tokens_est=context["system_tokens_est"],
+        history_tokens_est=context["history_tokens_est"],
+        attachment_tokens_est=attachment_tokens,
+    )
+
 
-def get_gemini_model():
+def get_gemini_api_key() -> Optional[str]:
     api_key = os.getenv("GEMINI_API_KEY")
     if not api_key:
         try:
             api_key = st.secrets.get("GEMINI_API_KEY")
         except Exception:
             api_key = None
-    if not api_key or genai is None:
+    return api_key
+
+def get_gemini_client() -> Optional[llm.GeminiClientManager]:
+    try:
+        return llm.get_client_manager(get_gemini_api_key())
+    except Exception:
+        return None
+
+def get_gemini_model(tier: str = "default"):
+    client = get_gemini_client()
+    if client is None:
         return None
     try:
-        genai.configure(api_key=api_key)
-        return genai.GenerativeModel("gemini-2.5-flash")
+        return client.model(tier)
     except Exception:
         return None
 
+def call_gemini(fn, tier: str = "default"):
+    """Run fn(timeout) with the client's deadlines, retries and circuit breaker."""
+    client = get_gemini_client()
+    if client is None:
+        return fn(llm.REQUEST_TIMEOUT_SECONDS)
+    return client.call(fn, tier)
+
 def upload_pdf_to_gemini(pdf_path: str):
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key or genai is None:
+    client = get_gemini_client()
+    if client is None:
         return None
+    context = usage_context("pdf_upload")
+    started = time.perf_counter()
     try:
-        genai.configure(api_key=api_key)
-        uploaded_file = genai.upload_file(pdf_path)
-        return uploaded_file
+        handle, source = client.upload_file(pdf_path)
     except Exception as e:
+        record_llm_usage(context, "upload", "api", started, ok=False)
         st.error(f"Error uploading PDF: {e}")
         return None
+    record_llm_usage(context, "upload", "api" if source == "upload" else "reuse", started)
+    return handle
 
 PERSONALITY_PROMPTS = {
     "Socratic": '''You are a Socratic-style history tutor who guides students through layered questioning so they uncover answers themselves.
@@ -709,7 +866,18 @@ def mark_episode_mastered(episode_num: int):
     st.session_state.narrative_episode = episode_num + 1 if episode_num < 4 else 4
     st.session_state.narrative_episode_phase = "setup"
     
-    save_persisted_state()
+    mark_state_dirty()
+
+    if PREFETCH_REPLIES and st.session_state.get("personality") == "Narrative":
+        # The learner will most likely ask for the next episode. page_chat() starts writing it once
+        # the rest of this turn's updates (which may rebuild the chat) are done.
+        st.session_state.next_episode_prefetch_wanted = True
+
+
+def next_episode_query() -> str:
+    """What the "Next Episode" button sends."""
+    current_ep = st.session_state.get("narrative_episode", 1)
+    return f"I'm ready for Episode {current_ep + 1 if current_ep < 4 else 'the chapter recap'}."
 
 
 def mark_subtopic_mastered(key: str):
@@ -733,7 +901,7 @@ def mark_subtopic_mastered(key: str):
             st.session_state.narrative_episode = 1
             st.session_state.narrative_episode_phase = "setup"
             st.toast("New subtopic unlocked!", icon="🚀")
-        save_persisted_state()
+        mark_state_dirty()
 
 
 def get_current_subtopic_status():
@@ -840,7 +1008,7 @@ def record_bandit_reward(action_type: str, action: str, reward: float):
         bandit_stats[rewards_key][action] = bandit_stats[rewards_key][action][-max_history:]
     
     st.session_state.bandit_stats = bandit_stats
-    save_persisted_state()
+    mark_state_dirty()
 
 
 def record_user_feedback(message_idx: int, feedback: str):
@@ -848,7 +1016,7 @@ def record_user_feedback(message_idx: int, feedback: str):
     Record user thumbs up/down feedback and update bandit rewards.
     
     Args:
-        message_idx: Index of the message being rated
+        message_idx: Position of the message in the full history (including unloaded pages)
         feedback: "up" for thumbs up, "down" for thumbs down
     """
     # Store feedback in session state
@@ -858,8 +1026,9 @@ def record_user_feedback(message_idx: int, feedback: str):
     st.session_state.message_feedback[str(message_idx)] = feedback
     
     # Get the message metadata to understand context
-    if message_idx < len(st.session_state.messages):
-        msg = st.session_state.messages[message_idx]
+    local_idx = message_idx - st.session_state.get("messages_offset", 0)
+    if 0 <= local_idx < len(st.session_state.messages):
+        msg = st.session_state.messages[local_idx]
         metadata = msg.metadata if isinstance(msg, Message) else msg.get("metadata", {})
         metadata = metadata or {}
         
@@ -889,7 +1058,7 @@ def record_user_feedback(message_idx: int, feedback: str):
             bandit_stats["response_quality_scores"] = bandit_stats["response_quality_scores"][-50:]
         st.session_state.bandit_stats = bandit_stats
     
-    save_persisted_state()
+    mark_state_dirty()
     
     # Show subtle acknowledgment
     if feedback == "up":
@@ -1003,7 +1172,7 @@ def check_learning_point_understanding():
                 lp_progress[next_lp_key] = "active"
         
         st.session_state.learning_point_progress[current_subtopic] = lp_progress
-        save_persisted_state()
+        mark_state_dirty()
         return True
     
     return False
@@ -1013,7 +1182,7 @@ def unlock_subtopic(key: str):
     progress = st.session_state.subtopic_progress.setdefault(key, {"unlocked": False, "mastered": False})
     if not progress["unlocked"]:
         progress["unlocked"] = True
-        save_persisted_state()
+        mark_state_dirty()
 
 
 def rotate_community_message() -> str:
@@ -1127,9 +1296,13 @@ def build_tutor_context(personality: str, pdf_ref=None, continuation_context: st
                         context += "\n\nStay focused on these points. Do not add extra details or explore tangents."
     
     if pdf_ref:
+        if get_curriculum_index() is not None:
+            source, quoted = "the curriculum excerpts included with each message", "the excerpts"
+        else:
+            source, quoted = "the uploaded PDF", "the PDF"
         context += (
-            "\n\nCURRICULUM INTEGRATION: Use the uploaded PDF only as background knowledge. "
-            "Summarise or paraphrase ideas in fresh language. Never quote the PDF verbatim."
+            f"\n\nCURRICULUM INTEGRATION: Use {source} only as background knowledge. "
+            f"Summarise or paraphrase ideas in fresh language. Never quote {quoted} verbatim."
         )
     
     active_concept = get_concept()
@@ -1150,49 +1323,517 @@ def build_tutor_context(personality: str, pdf_ref=None, continuation_context: st
     return context
 
 
-def chat_with_tutor(model, personality: str, user_message: str, pdf_ref=None, continuation_prompt: str = None) -> str:
-    """Chat with the tutor model with defensive error handling."""
-    if model is None:
-        return "(Error: AI model not initialized. Please check your GEMINI_API_KEY configuration and try again.)"
-    
-    try:
-        pdf_id = getattr(pdf_ref, "name", None) or getattr(pdf_ref, "uri", None)
-        chat = st.session_state.get("chat_session")
-        needs_reset = (
-            chat is None
-            or st.session_state.get("chat_session_personality") != personality
-            or st.session_state.get("chat_session_pdf_id") != pdf_id
-        )
+@dataclass
+class CurriculumExcerpts:
+    """Stands in for an uploaded file when the tutor is only sent passages from the local index."""
+    name: str
 
-        if needs_reset:
-            system_context = build_tutor_context(personality, pdf_ref, continuation_prompt)
-            chat_history = [{"role": "user", "parts": [system_context]}]
-            chat = model.start_chat(history=chat_history)
-            st.session_state.chat_session = chat
-            st.session_state.chat_session_personality = personality
-            st.session_state.chat_session_pdf_id = pdf_id
 
-        message_to_send = user_message
-        if continuation_prompt:
-            message_to_send = f"{user_message}\n\n[SYSTEM NOTE: {continuation_prompt}]"
+def remember_curriculum_pdf(path: str):
+    """Record the loaded PDF and build its passage index up front."""
+    st.session_state.pdf_local_path = path
+    st.session_state.pdf_index_key = llm.file_sha256(path)
+    get_curriculum_index()
 
-        if pdf_ref:
-            response = chat.send_message([message_to_send, pdf_ref])
-        else:
-            response = chat.send_message(message_to_send)
 
-        reply_text = getattr(response, "text", "") or ""
+def load_curriculum_pdf(path: str):
+    """Index a curriculum PDF and return the reference tutor turns should use, or None on failure.
+
+    The file only goes to Gemini when there's no passage index to send
+    excerpts from (full-PDF mode, or a PDF without a text layer).
+    """
+    remember_curriculum_pdf(path)
+    if get_curriculum_index() is not None:
+        return CurriculumExcerpts(name=f"excerpts:{st.session_state.pdf_index_key}")
+    return upload_pdf_to_gemini(path)
+
+
+def get_curriculum_index() -> Optional[pdf_index.BM25Index]:
+    """Passage index for the loaded PDF, or None in full-PDF mode or when it has no text layer."""
+    if PDF_CONTEXT_MODE != "passages":
+        return None
+    path = st.session_state.get("pdf_local_path")
+    key = st.session_state.get("pdf_index_key")
+    if not path or not key:
+        return None
+    return pdf_index.get_pdf_index(path, key)
+
+
+EXCERPTS_MARKER = "\n\n[CURRICULUM EXCERPTS]\n"
+
+
+def completed_learning_points() -> List[str]:
+    progress = st.session_state.get("learning_point_progress", {}).get(st.session_state.get("current_subtopic"), {})
+    return [
+        point for idx, point in enumerate(get_current_learning_points())
+        if progress.get(f"lp_{idx}") == "completed"
+    ]
+
+
+def start_tutor_chat(model, personality: str, pdf_ref=None, continuation_prompt: str = None,
+                     summary: str = "", turns: Optional[List[Tuple[str, str]]] = None):
+    """Start a chat from the system context, an optional summary of earlier turns and verbatim recent turns."""
+    turns = list(turns or [])
+    pdf_id = getattr(pdf_ref, "name", None) or getattr(pdf_ref, "uri", None)
+    system_context = build_tutor_context(personality, pdf_ref, continuation_prompt)
+    if summary:
+        done = completed_learning_points()
+        system_context += "\n\nEARLIER IN THIS SESSION (condensed; do not repeat covered material):"
+        if done:
+            system_context += "\nLearning points already completed: " + "; ".join(done)
+        system_context += f"\n{summary}"
+    chat = model.start_chat(history=[{"role": "user", "parts": [system_context]}] + chat_context.history_for(turns))
+    st.session_state.chat_session = chat
+    st.session_state.chat_session_personality = personality
+    st.session_state.chat_session_pdf_id = pdf_id
+    st.session_state.chat_turns = turns
+    st.session_state.chat_summary = summary
+    st.session_state.chat_summary_points_done = len(completed_learning_points())
+    st.session_state.chat_system_tokens = chat_context.estimate_tokens(system_context)
+    st.session_state.chat_context_tokens = st.session_state.chat_system_tokens + chat_context.turns_tokens(turns)
+    seed = "\x00".join([getattr(model, "model_name", ""), str(pdf_id), system_context] + [t for turn in turns for t in turn])
+    st.session_state.chat_session_digest = hashlib.sha256(seed.encode("utf-8")).hexdigest()
+    return chat
+
+
+def should_compact_chat() -> bool:
+    """Over the token budget, or a learning point was completed since the last rebuild."""
+    turns = st.session_state.get("chat_turns", [])
+    if len(turns) <= chat_context.KEEP_RECENT_TURNS:
+        return False
+    if chat_context.needs_compaction(st.session_state.get("chat_context_tokens", 0), turns):
+        return True
+    return len(completed_learning_points()) > st.session_state.get("chat_summary_points_done", 0)
+
+
+def compact_tutor_chat(model, personality: str, pdf_ref=None):
+    """Fold older turns into the running summary and rebuild the chat around the recent ones."""
+    summary, recent = chat_context.compact(st.session_state.get("chat_summary", ""), st.session_state.chat_turns)
+    st.session_state.chat_compactions = st.session_state.get("chat_compactions", 0) + 1
+    return start_tutor_chat(model, personality, pdf_ref, summary=summary, turns=recent)
+
+
+def rehydrate_tutor_chat(model, personality: str, pdf_ref=None, continuation_prompt: str = None):
+    """Start a chat that already knows the conversation on screen.
+
+    Used whenever chat_session is missing, e.g. after a restart or a
+    failed call. The loaded messages are paired into turns; the most
+    recent stay verbatim and the rest go into the rolling summary.
+    """
+    start = time.perf_counter()
+    messages = [
+        {"role": m.role, "content": m.content, "metadata": m.metadata} if isinstance(m, Message) else m
+        for m in st.session_state.get("messages", [])
+    ]
+    messages = [m for m in messages if m.get("content") != DEGRADED_REPLY]
+    turns = chat_context.turns_from_messages(messages, personality)
+    summary, recent = chat_context.compact("", turns)
+    chat = start_tutor_chat(model, personality, pdf_ref, continuation_prompt, summary, recent)
+    if turns:
+        stats = st.session_state.setdefault("rehydrate_stats", {"count": 0, "turns": 0, "last_ms": 0.0, "max_ms": 0.0})
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        stats["count"] += 1
+        stats["turns"] = len(turns)
+        stats["last_ms"] = elapsed_ms
+        stats["max_ms"] = max(stats["max_ms"], elapsed_ms)
+    return chat
+
+
+def prepare_tutor_chat(model, personality: str, user_message: str, pdf_ref=None, continuation_prompt: str = None):
+    """Return the (chat session, message payload) for the next tutor turn, starting a chat if needed."""
+    pdf_id = getattr(pdf_ref, "name", None) or getattr(pdf_ref, "uri", None)
+    chat = st.session_state.get("chat_session")
+    needs_reset = (
+        chat is None
+        or st.session_state.get("chat_session_personality") != personality
+        or st.session_state.get("chat_session_pdf_id") != pdf_id
+    )
+
+    if needs_reset:
+        chat = rehydrate_tutor_chat(model, personality, pdf_ref, continuation_prompt)
+    elif should_compact_chat():
+        chat = compact_tutor_chat(model, personality, pdf_ref)
+
+    message_to_send = user_message
+    if continuation_prompt:
+        message_to_send = f"{user_message}\n\n[SYSTEM NOTE: {continuation_prompt}]"
+
+    if pdf_ref:
+        index = get_curriculum_index()
+        if index is None:
+            if isinstance(pdf_ref, CurriculumExcerpts):
+                return chat, message_to_send
+            return chat, [message_to_send, pdf_ref]
+        query = " ".join(get_current_learning_points() + [user_message])
+        passages = pdf_index.format_passages(index.search(query))
+        if passages:
+            return chat, f"{message_to_send}{EXCERPTS_MARKER}{passages}"
+    return chat, message_to_send
+
+
+def payload_text(payload) -> str:
+    return payload[0] if isinstance(payload, list) else payload
+
+
+def tutor_cache_key(payload) -> str:
+    """Key a prompt by everything the model has seen in this chat so far plus the prompt itself."""
+    digest = st.session_state.get("chat_session_digest", "")
+    return hashlib.sha256(f"{digest}\x00{payload_text(payload)}".encode("utf-8")).hexdigest()
+
+
+def record_tutor_turn(payload, reply_text: str, cache_key: Optional[str] = None):
+    """Fold a completed turn into the chat digest and, for cacheable prompts, store the reply."""
+    if cache_key:
+        response_cache.get_response_cache().put(cache_key, reply_text)
+    discard_prefetches()
+    text = payload_text(payload)
+    turn = f"{st.session_state.get('chat_session_digest', '')}\x00{text}\x00{reply_text}"
+    st.session_state.chat_session_digest = hashlib.sha256(turn.encode("utf-8")).hexdigest()
+    # Excerpts count towards this prompt but aren't kept when the chat is rebuilt.
+    st.session_state.chat_turns = st.session_state.get("chat_turns", []) + [(text.split(EXCERPTS_MARKER)[0], reply_text)]
+    st.session_state.chat_context_tokens = (
+        st.session_state.get("chat_context_tokens", 0)
+        + chat_context.estimate_tokens(text)
+        + chat_context.estimate_tokens(reply_text)
+    )
+
+
+def lookup_cached_reply(model, payload, cache_key: Optional[str]) -> Optional[str]:
+    """Return a cached reply and replay it into the chat history, or None on a miss."""
+    if not cache_key:
+        return None
+    cached = response_cache.get_response_cache().get(cache_key)
+    if cached is None:
+        return None
+    replay_tutor_turn(model, payload, cached)
+    return cached
+
+
+def replay_tutor_turn(model, payload, reply_text: str):
+    """Add a turn this session didn't send itself (cached or shared) to its chat history."""
+    chat = st.session_state.chat_session
+    history = list(chat.history) + [
+        {"role": "user", "parts": payload if isinstance(payload, list) else [payload]},
+        {"role": "model", "parts": [reply_text]},
+    ]
+    st.session_state.chat_session = model.start_chat(history=history)
+    record_tutor_turn(payload, reply_text)
+
+
+def send_shared(key: str, fn) -> Tuple[str, bool]:
+    """Run fn() once for all sessions sending an identical prompt at the same moment.
+
+    Returns (reply text, shared); when shared is True the reply came from
+    another session's call and this session's chat hasn't seen it yet.
+    """
+    return llm.get_single_flight().do(key, fn, timeout=llm.CALL_DEADLINE_SECONDS + llm.REQUEST_TIMEOUT_SECONDS)
+
+
+DEGRADED_REPLY = (
+    "I'm having trouble reaching my notes right now, so let's pause for a moment. "
+    "Your progress is saved - send your message again in a minute and we'll pick up where we left off."
+)
+
+
+def chat_with_tutor(model, personality: str, user_message: str, pdf_ref=None, continuation_prompt: str = None,
+                    cacheable: bool = False, flow: str = "chat") -> str:
+    """Chat with the tutor model with defensive error handling.
+
+    cacheable marks prompts that are the same for every learner (intro,
+    primer, quick-starts); their replies are shared through the response
+    cache whenever the conversation leading up to them is identical.
+    flow names the button or path that asked, for usage rollups.
+    """
+    if model is None:
+        return "(Error: AI model not initialized. Please check your GEMINI_API_KEY configuration and try again.)"
+    
+    try:
+        started = time.perf_counter()
+        chat, payload = prepare_tutor_chat(model, personality, user_message, pdf_ref, continuation_prompt)
+        context = usage_context(flow, payload)
+        key = tutor_cache_key(payload)
+        cache_key = key if cacheable and not continuation_prompt else None
+        cached = lookup_cached_reply(model, payload, cache_key)
+        if cached is not None:
+            record_llm_usage(context, "chat", "cache", started)
+            return cached
+
+        def send() -> str:
+            call_started = time.perf_counter()
+            try:
+                response = call_gemini(lambda timeout: chat.send_message(payload, request_options={"timeout": timeout}))
+            except Exception:
+                record_llm_usage(context, "chat", "api", call_started, ok=False)
+                raise
+            record_llm_usage(context, "chat", "api", call_started, response)
+            return getattr(response, "text", "") or ""
+
+        reply_text, shared = send_shared(key, send)
+        if shared:
+            record_llm_usage(context, "chat", "shared", started)
         
         if not reply_text or reply_text.strip() == "":
             st.error("Tutor generated an empty response. Please try again.")
             return "I'm having trouble generating a response right now. Could you please rephrase your question or try again?"
         
+        if shared:
+            replay_tutor_turn(model, payload, reply_text)
+        else:
+            record_tutor_turn(payload, reply_text, cache_key)
         return reply_text
     except Exception as e:
+        if isinstance(e, llm.CircuitOpenError) or llm.is_retryable(e):
+            # The chat history is untouched by a failed send, so keep it for the next try.
+            st.warning("The tutor is having trouble reaching the AI service.")
+            return DEGRADED_REPLY
+        st.session_state.chat_session = None
+        st.error(f"Chat error: {e}")
+        return f"I encountered an error while processing your request: {e}. Please try again."
+
+
+class TagStreamFilter:
+    """Rewrites tutor control tags in a streamed reply as chunks arrive.
+
+    Text that might be the start of a tag split across chunks is held
+    back until it can be resolved, so the learner never sees a raw
+    `[MINI-Q]` or `[MASTERED episode_2]` flash on screen. The raw reply
+    still goes through parse_tutor_response() once the stream ends.
+    """
+
+    REPLACEMENTS = {
+        "[MINI-Q]": "**Mini-Question:**",
+        "[QUIZ]": "**Quiz:**",
+        "[SUBTOPIC_COMPLETE]": "",
+    }
+    MASTERED_PATTERN = re.compile(r"\[MASTERED episode_\d+\]")
+    MAX_TAG_LENGTH = 32
+
+    def __init__(self):
+        self._pending = ""
+
+    def feed(self, chunk: str) -> str:
+        self._pending += chunk
+        out = []
+        while self._pending:
+            start = self._pending.find("[")
+            if start == -1:
+                out.append(self._pending)
+                self._pending = ""
+                break
+            out.append(self._pending[:start])
+            self._pending = self._pending[start:]
+            end = self._pending.find("]")
+            if end == -1 and len(self._pending) < self.MAX_TAG_LENGTH:
+                break  # Might still become a tag; wait for more text.
+            token = self._pending[:end + 1] if end != -1 else ""
+            if self.MASTERED_PATTERN.fullmatch(token):
+                replacement = ""
+            else:
+                replacement = self.REPLACEMENTS.get(token)
+            if replacement is None:
+                # Not a tag (e.g. a markdown link); emit the bracket and rescan the rest.
+                out.append(self._pending[0])
+                self._pending = self._pending[1:]
+                continue
+            out.append(replacement)
+            self._pending = self._pending[end + 1:]
+        return "".join(out)
+
+    def flush(self) -> str:
+        rest, self._pending = self._pending, ""
+        return rest
+
+
+def stream_tutor_reply(model, personality: str, user_message: str, pdf_ref=None, continuation_prompt: str = None,
+                       cacheable: bool = False, flow: str = "chat") -> str:
+    """Like chat_with_tutor(), but renders the reply token by token and returns the raw text."""
+    if model is None:
+        return "(Error: AI model not initialized. Please check your GEMINI_API_KEY configuration and try again.)"
+
+    tag_filter = TagStreamFilter()
+
+    try:
+        started = time.perf_counter()
+        chat, payload = prepare_tutor_chat(model, personality, user_message, pdf_ref, continuation_prompt)
+        context = usage_context(flow, payload)
+        key = tutor_cache_key(payload)
+        cache_key = key if cacheable and not continuation_prompt else None
+        cached = lookup_cached_reply(model, payload, cache_key)
+        if cached is not None:
+            record_llm_usage(context, "stream", "cache", started)
+            with st.chat_message("assistant"):
+                st.markdown(tag_filter.feed(cached) + tag_filter.flush())
+            return cached
+
+        client = get_gemini_client()
+        chunks: "queue.Queue[Optional[str]]" = queue.Queue()
+
+        def fetch() -> str:
+            # Runs on a worker thread and may be shared with other sessions, so no st.* calls in here.
+            raw_parts = []
+            first_token_at = None
+            call_started = time.perf_counter()
+
+            def send(timeout: float):
+                return chat.send_message(payload, stream=True, request_options={"timeout": timeout})
+
+            response = None
+            try:
+                response = client.call(send) if client is not None else send(llm.REQUEST_TIMEOUT_SECONDS)
+                for chunk in response:
+                    text = getattr(chunk, "text", "") or ""
+                    if text and first_token_at is None:
+                        first_token_at = time.perf_counter()
+                    raw_parts.append(text)
+                    chunks.put(text)
+            except Exception:
+                record_llm_usage(context, "stream", "api", call_started, first_token_at=first_token_at, ok=False)
+                raise
+            record_llm_usage(context, "stream", "api", call_started, response, first_token_at)
+            return "".join(raw_parts)
+
+        # The call runs off the script thread so that a rerun of this session can't cut it
+        # short for other sessions sharing it; this thread only renders what arrives.
+        outcome: Future = Future()
+
+        def run():
+            try:
+                outcome.set_result(send_shared(key, fetch))
+            except BaseException as e:
+                outcome.set_exception(e)
+            finally:
+                chunks.put(None)
+
+        threading.Thread(target=run, name="tutorquest-stream", daemon=True).start()
+
+        def visible_chunks():
+            while True:
+                text = chunks.get()
+                if text is None:
+                    break
+                shown = tag_filter.feed(text)
+                if shown:
+                    yield shown
+            text, shared = outcome.result()
+            if shared:
+                shown = tag_filter.feed(text)
+                if shown:
+                    yield shown
+            tail = tag_filter.flush()
+            if tail:
+                yield tail
+
+        rendered = False
+        try:
+            with st.chat_message("assistant"):
+                st.write_stream(visible_chunks())
+            rendered = True
+        finally:
+            if not rendered:
+                # Interrupted by an error or a rerun; the worker may still add this turn to the
+                # chat's history behind the session's back, so rebuild the chat next turn.
+                st.session_state.chat_session = None
+        reply_text, shared = outcome.result()
+        if shared:
+            record_llm_usage(context, "stream", "shared", started)
+    except Exception as e:
+        # A stream that broke off leaves the chat unusable; it's rehydrated on the next turn.
         st.session_state.chat_session = None
+        if isinstance(e, llm.CircuitOpenError) or llm.is_retryable(e):
+            st.warning("The tutor is having trouble reaching the AI service.")
+            return DEGRADED_REPLY
         st.error(f"Chat error: {e}")
         return f"I encountered an error while processing your request: {e}. Please try again."
 
+    if not reply_text.strip():
+        st.error("Tutor generated an empty response. Please try again.")
+        return "I'm having trouble generating a response right now. Could you please rephrase your question or try again?"
+    if shared:
+        replay_tutor_turn(model, payload, reply_text)
+    else:
+        record_tutor_turn(payload, reply_text, cache_key)
+    return reply_text
+
+
+def start_prefetch(slot: str, model, personality: str, query: str, pdf_ref=None):
+    """Generate the reply to `query` on a worker thread, using a fork of the current chat."""
+    client = get_gemini_client()
+    if model is None or client is None:
+        return
+    chat, payload = prepare_tutor_chat(model, personality, query, pdf_ref)
+    key = tutor_cache_key(payload)
+    prefetches = st.session_state.setdefault("prefetches", {})
+    existing = prefetches.get(slot)
+    if existing is not None:
+        if existing.key == key:
+            return
+        prefetch.get_prefetcher().discard(existing)
+    fork = model.start_chat(history=list(chat.history))
+    context = usage_context(slot, payload)
+
+    def generate():
+        started = time.perf_counter()
+        try:
+            response = client.call(lambda timeout: fork.send_message(payload, request_options={"timeout": timeout}))
+        except Exception:
+            record_llm_usage(context, "prefetch", "api", started, ok=False)
+            raise
+        record_llm_usage(context, "prefetch", "api", started, response)
+        text = getattr(response, "text", "") or ""
+        usage = getattr(response, "usage_metadata", None)
+        tokens = getattr(usage, "total_token_count", 0) or chat_context.estimate_tokens(payload_text(payload) + text)
+        return text, tokens
+
+    prefetches[slot] = prefetch.get_prefetcher().submit(
+        slot, key, generate,
+        chat=fork, personality=personality, subtopic=st.session_state.get("current_subtopic"),
+    )
+
+
+def take_prefetched_reply(slot: str, model, personality: str, query: str, pdf_ref=None) -> Optional[str]:
+    """Return the prefetched reply for `query` and adopt its chat, or None if there isn't a matching one."""
+    entry = st.session_state.get("prefetches", {}).pop(slot, None)
+    if entry is None:
+        return None
+    started = time.perf_counter()
+    _, payload = prepare_tutor_chat(model, personality, query, pdf_ref)
+    if entry.key != tutor_cache_key(payload):
+        prefetch.get_prefetcher().discard(entry)
+        return None
+    context = usage_context(slot, payload)
+    if entry.future.done():
+        reply = prefetch.get_prefetcher().claim(entry)
+    else:
+        with st.spinner("Tutor is thinking..."):
+            reply = prefetch.get_prefetcher().claim(entry)
+    if not reply or not reply.strip():
+        return None
+    record_llm_usage(context, "chat", "prefetch", started)
+    st.session_state.chat_session = entry.meta["chat"]
+    record_tutor_turn(payload, reply)
+    return reply
+
+
+def discard_prefetches(personality: Optional[str] = None, subtopic: Optional[str] = None):
+    """Drop prefetched replies; with arguments, only those made for another personality or subtopic."""
+    prefetches = st.session_state.get("prefetches", {})
+    for slot, entry in list(prefetches.items()):
+        if personality is None or entry.meta["personality"] != personality or entry.meta["subtopic"] != subtopic:
+            prefetch.get_prefetcher().discard(prefetches.pop(slot))
+
+
+def get_tutor_reply(model, personality: str, user_message: str, pdf_ref=None, continuation_prompt: str = None,
+                    spinner_text: str = "Tutor is thinking...", echo: Optional[str] = None,
+                    cacheable: bool = False, flow: str = "chat") -> str:
+    """Fetch the next tutor reply, streaming it on screen when STREAM_REPLIES is on."""
+    if STREAM_REPLIES:
+        if echo:
+            with st.chat_message("user"):
+                st.markdown(echo)
+        return stream_tutor_reply(model, personality, user_message, pdf_ref, continuation_prompt, cacheable, flow)
+    with st.spinner(spinner_text):
+        return chat_with_tutor(model, personality, user_message, pdf_ref, continuation_prompt, cacheable, flow)
+
 
 def parse_tutor_response(response: str):
     """Parse tutor response for tags and signals."""
@@ -1201,7 +1842,6 @@ def parse_tutor_response(response: str):
     subtopic_complete = False
     
     if "[MASTERED episode_" in response:
-        import re
         match = re.search(r'\[MASTERED episode_(\d+)\]', response)
         if match:
             mastered_episode = int(match.group(1))
@@ -1241,7 +1881,7 @@ def ensure_initial_tutor_message(model):
         return
     if st.session_state.messages:
         st.session_state.intro_sent = True
-        save_persisted_state()
+        mark_state_dirty()
         return
     if model is None:
         return
@@ -1256,6 +1896,8 @@ def ensure_initial_tutor_message(model):
                 personality,
                 prompt,
                 st.session_state.pdf_file_ref,
+                cacheable=True,
+                flow="intro",
             )
         
         if not reply or reply.strip() == "":
@@ -1285,7 +1927,7 @@ def ensure_initial_tutor_message(model):
         st.session_state.hint_given_this_question = False
 
     st.session_state.intro_sent = True
-    save_persisted_state()
+    mark_state_dirty()
 
 
 def check_answer_quality(user_answer: str, question_type: str, personality: str):
@@ -1483,6 +2125,7 @@ def sidebar_nav():
                         st.session_state.chat_session_personality = None
                         st.session_state.chat_session_pdf_id = None
                         st.session_state.messages = []
+                        st.session_state.messages_offset = 0
                         st.session_state.awaiting_answer = False
                         st.session_state.question_type = None
                         st.session_state.current_topic = "General Tutoring"
@@ -1491,7 +2134,7 @@ def sidebar_nav():
                         st.session_state.narrative_episode_phase = "setup"
                         st.session_state.message_feedback = {}  # Reset feedback on personality change
                         st.session_state.last_question_asked = None  # Reset question tracking
-                        save_persisted_state()
+                        mark_state_dirty()
                         st.rerun()
             
             st.caption(descriptions[st.session_state.personality])
@@ -1519,24 +2162,45 @@ def sidebar_nav():
             st.divider()
         
         if len(st.session_state.messages) > 0:
-            chat_export = []
-            for msg in st.session_state.messages:
-                if isinstance(msg, Message):
-                    chat_export.append({"role": msg.role, "content": msg.content})
-                elif isinstance(msg, dict):
-                    chat_export.append({"role": msg.get("role", "unknown"), "content": msg.get("content", "")})
-            
-            chat_json = json.dumps(chat_export, indent=2)
+            if st.session_state.get("messages_offset", 0) > 0:
+                # Older pages stay in the DB until someone actually wants the whole transcript,
+                # and the prepared export is reused until it's downloaded or a new message arrives.
+                prepared = st.session_state.get("export_chat_json")
+                chat_json = None
+                if prepared and prepared[0] == len(st.session_state.messages):
+                    chat_json = prepared[1]
+                elif st.button("Prepare Full Chat History", use_container_width=True):
+                    st.session_state.export_chat_json = (
+                        len(st.session_state.messages), json.dumps(full_transcript(), indent=2)
+                    )
+                    st.rerun()
+            else:
+                chat_json = json.dumps(full_transcript(), indent=2)
             
-            st.download_button(
-                label="Download Chat History",
-                data=chat_json,
-                file_name=f"silk_road_chat_{st.session_state.current_subtopic}.json",
-                mime="application/json",
-                use_container_width=True
-            )
+            if chat_json is not None:
+                st.download_button(
+                    label="Download Chat History",
+                    data=chat_json,
+                    file_name=f"silk_road_chat_{st.session_state.current_subtopic}.json",
+                    mime="application/json",
+                    use_container_width=True,
+                    on_click=lambda: st.session_state.pop("export_chat_json", None),
+                )
         
         st.divider()
+
+        if SHOW_METRICS:
+            with st.expander("Metrics"):
+                persist_stats = get_persist_stats()
+                writer_stats = persistence.get_writer().stats()
+                st.caption(
+                    f"Saves: {persist_stats['flushes']} written for {persist_stats['marks']} changes "
+                    f"({persist_stats['flushes_saved']} saved by coalescing)"
+                )
+                st.caption(
+                    f"Writer: queue {writer_stats['queue_depth']} • avg {writer_stats['avg_write_ms']:.1f} ms • "
+                    f"{writer_stats['failures']} failures • {writer_stats['dropped']} dropped"
+                )
         
         with st.container(border=True):
             st.markdown("#### Profile")
@@ -1544,11 +2208,47 @@ def sidebar_nav():
             st.markdown(f"**{username}**")
             st.caption(f"Level {st.session_state.level} • {st.session_state.xp} XP")
             if st.button("Sign Out", use_container_width=True, type="secondary"):
+                token = st.session_state.get("session_token")
+                if token:
+                    db.revoke_session(token)
                 for key in list(st.session_state.keys()):
                     del st.session_state[key]
+                set_session_cookie(None)
                 st.rerun()
 
 
+def render_leaderboard():
+    user_id = st.session_state.get("user_id")
+    with st.container(border=True):
+        st.subheader("Leaderboard")
+        tab_all, tab_week = st.tabs(["All time", "This week"])
+        with tab_all:
+            leaders = db.get_leaderboard(limit=5)
+            if leaders:
+                lines = []
+                for entry in leaders:
+                    name = f"**{entry['username']}**" if entry["user_id"] == user_id else entry["username"]
+                    lines.append(f"{entry['rank']}. {name} • Level {entry['level']} • {entry['xp']} XP")
+                st.markdown("\n".join(lines))
+            else:
+                st.caption("No learners ranked yet.")
+            if user_id:
+                rank = db.get_user_rank(user_id)
+                if rank:
+                    st.caption(f"Your rank: #{rank}")
+        with tab_week:
+            weekly = db.get_weekly_leaderboard(limit=5)
+            if weekly:
+                st.markdown("\n".join(
+                    f"{entry['rank']}. {entry['username']} • +{entry['xp_gained']} XP"
+                    for entry in weekly
+                ))
+            else:
+                st.caption("No XP earned this week yet.")
+            if user_id:
+                st.caption(f"You: +{db.get_weekly_xp(user_id)} XP in the last 7 days")
+
+
 def page_home():
     st.title("Welcome back")
     st.caption("Track your learning streaks, XP, and level progress.")
@@ -1602,6 +2302,9 @@ def page_home():
                 st.subheader("Tutor Feedback")
                 st.markdown(f"**{feedback_stats['rate']}%** satisfaction")
                 st.caption(f"Based on {feedback_stats['total']} ratings")
+        
+        st.markdown("\n")
+        render_leaderboard()
 
     st.markdown("---")
     st.subheader("Daily actions")
@@ -1621,7 +2324,7 @@ def page_home():
             st.session_state.page = "Tutoring Chat"
             st.session_state.challenge_active = True
             st.toast("Challenge armed! Head to Tutoring Chat to get your tough question.", icon="⚡")
-            save_persisted_state()
+            mark_state_dirty()
             st.rerun()
 
     st.info("Tip: Chat with your AI tutor and answer questions to earn XP!")
@@ -1643,6 +2346,7 @@ def page_chat():
     if model is None:
         st.error("Gemini API key not configured. Please set GEMINI_API_KEY in your environment or Streamlit secrets.")
         return
+    discard_prefetches(personality, st.session_state.get("current_subtopic"))
 
     with st.expander("Upload Curriculum (PDF)", expanded=not st.session_state.pdf_uploaded):
         uploaded_file = st.file_uploader(
@@ -1656,8 +2360,8 @@ def page_chat():
             with open(pdf_path, "wb") as f:
                 f.write(uploaded_file.getbuffer())
             
-            with st.spinner("Uploading PDF..."):
-                pdf_ref = upload_pdf_to_gemini(pdf_path)
+            with st.spinner("Loading PDF..."):
+                pdf_ref = load_curriculum_pdf(pdf_path)
                 if pdf_ref:
                     st.session_state.pdf_file_ref = pdf_ref
                     st.session_state.pdf_uploaded = True
@@ -1665,6 +2369,7 @@ def page_chat():
                     st.session_state.chat_session_personality = None
                     st.session_state.chat_session_pdf_id = None
                     st.session_state.messages = []
+                    st.session_state.messages_offset = 0
                     st.session_state.awaiting_answer = False
                     st.session_state.question_type = None
                     st.session_state.current_topic = "General Tutoring"
@@ -1672,7 +2377,7 @@ def page_chat():
                     st.session_state.topic_refresh_counter = 0
                     st.session_state.message_feedback = {}
                     st.session_state.last_question_asked = None
-                    save_persisted_state()
+                    mark_state_dirty()
                     st.success(f"PDF uploaded: {uploaded_file.name}")
                     st.rerun()
     
@@ -1680,7 +2385,7 @@ def page_chat():
     if local_pdf.exists() and not st.session_state.pdf_uploaded:
         if st.button("Load Unit 2 Curriculum (2.1-2.7)"):
             with st.spinner("Loading curriculum..."):
-                pdf_ref = upload_pdf_to_gemini(str(local_pdf))
+                pdf_ref = load_curriculum_pdf(str(local_pdf))
                 if pdf_ref:
                     st.session_state.pdf_file_ref = pdf_ref
                     st.session_state.pdf_uploaded = True
@@ -1688,6 +2393,7 @@ def page_chat():
                     st.session_state.chat_session_personality = None
                     st.session_state.chat_session_pdf_id = None
                     st.session_state.messages = []
+                    st.session_state.messages_offset = 0
                     st.session_state.awaiting_answer = False
                     st.session_state.question_type = None
                     st.session_state.current_topic = "General Tutoring"
@@ -1695,12 +2401,13 @@ def page_chat():
                     st.session_state.topic_refresh_counter = 0
                     st.session_state.message_feedback = {}
                     st.session_state.last_question_asked = None
-                    save_persisted_state()
+                    mark_state_dirty()
                     st.success("Curriculum loaded!")
                     st.rerun()
 
     chip_query = None
     chip_topic = None
+    chip_flow = "chat"
 
     st.markdown("#### Silk Road Learning Routes")
     
@@ -1714,16 +2421,17 @@ def page_chat():
         if st.button("Route primer", use_container_width=True, help="Get an overview and learning roadmap for the Silk Road topic"):
             chip_query = active_concept["starter"]
             chip_topic = active_concept["title"]
+            chip_flow = "primer"
     with challenge_col:
         if st.button("Challenge Question", use_container_width=True, help="Get a tough synthesis question on everything discussed"):
             challenge_prompt = "Give me a challenge question on everything we've discussed in this chat so far. This should test deep synthesis and understanding across multiple concepts."
             
             st.session_state.messages.append(Message(role="user", content=challenge_prompt, metadata=None))
-            save_persisted_state()
+            mark_state_dirty()
             
             try:
-                with st.spinner("Preparing challenge question..."):
-                    reply = chat_with_tutor(model, personality, challenge_prompt, st.session_state.pdf_file_ref)
+                reply = get_tutor_reply(model, personality, challenge_prompt, st.session_state.pdf_file_ref,
+                                        spinner_text="Preparing challenge question...", flow="challenge")
                 
                 if not reply or reply.strip() == "":
                     reply = "Here's a challenge question: How did the geographic, political, and cultural factors of the Silk Road interact to shape the flow of trade and ideas between East and West?"
@@ -1745,7 +2453,7 @@ def page_chat():
             st.session_state.challenge_active = True
             st.session_state.current_hint_policy = st.session_state.get("hint_policy", "LIGHT_HINTS")
             st.session_state.hint_given_this_question = False
-            save_persisted_state()
+            mark_state_dirty()
             st.rerun()
 
     st.markdown("##### Quick starts:")
@@ -1774,23 +2482,32 @@ def page_chat():
         if st.button(starts[0][0], use_container_width=True):
             chip_query = starts[0][1]
             chip_topic = starts[0][0]
+            chip_flow = "quick_start"
     with pp2:
         if st.button(starts[1][0], use_container_width=True):
             chip_query = starts[1][1]
             chip_topic = starts[1][0]
+            chip_flow = "quick_start"
     with pp3:
         if st.button(starts[2][0], use_container_width=True):
             chip_query = starts[2][1]
             chip_topic = starts[2][0]
+            chip_flow = "quick_start"
     with pp4:
         if st.button("Surprise me", use_container_width=True):
             chip_query = f"Give me a fresh angle on {active_concept['title']} with a question to get started."
             chip_topic = active_concept["title"]
+            chip_flow = "surprise"
     
     ensure_initial_tutor_message(model)
 
     # Render chat messages with feedback buttons
     with st.container(border=True):
+        messages_offset = st.session_state.get("messages_offset", 0)
+        if messages_offset > 0:
+            if st.button(f"Show older messages ({messages_offset} earlier)", key="load_older_messages"):
+                load_older_messages()
+                st.rerun()
         for idx, m in enumerate(st.session_state.messages):
             if isinstance(m, dict):
                 role = m.get("role")
@@ -1816,9 +2533,12 @@ def page_chat():
                                     st.session_state.messages[idx].content = edited_text
                                 st.session_state.editing_message_idx = None
                                 st.session_state.messages = st.session_state.messages[:idx+1]
+                                mark_messages_changed(idx)
                                 
                                 # Clear feedback for removed messages
-                                keys_to_remove = [k for k in st.session_state.message_feedback.keys() if int(k) > idx]
+                                keys_to_remove = [
+                                    k for k in st.session_state.message_feedback.keys() if int(k) > messages_offset + idx
+                                ]
                                 for k in keys_to_remove:
                                     del st.session_state.message_feedback[k]
                                 
@@ -1827,7 +2547,8 @@ def page_chat():
                                 
                                 try:
                                     with st.spinner("Tutor is thinking..."):
-                                        reply = chat_with_tutor(model, personality, edited_text, st.session_state.pdf_file_ref)
+                                        reply = chat_with_tutor(model, personality, edited_text, st.session_state.pdf_file_ref,
+                                                                        flow="edit")
                                     
                                     if not reply or reply.strip() == "":
                                         reply = "I'm having trouble generating a response. Could you please try rephrasing your question?"
@@ -1860,7 +2581,7 @@ def page_chat():
                                     st.session_state.current_hint_policy = st.session_state.get("hint_policy", "LIGHT_HINTS")
                                     st.session_state.hint_given_this_question = False
                                 
-                                save_persisted_state()
+                                mark_state_dirty()
                                 st.rerun()
                         else:
                             st.markdown(content)
@@ -1874,7 +2595,7 @@ def page_chat():
                     st.markdown(content)
                     
                     # Render subtle feedback buttons beneath assistant messages
-                    render_feedback_buttons(idx)
+                    render_feedback_buttons(messages_offset + idx)
 
     user_input = st.chat_input("Ask a question or answer the tutor...")
     query = chip_query or user_input
@@ -1887,7 +2608,7 @@ def page_chat():
             topic_update = user_input.strip()
 
         st.session_state.messages.append(Message(role="user", content=query, metadata=None))
-        save_persisted_state()
+        mark_state_dirty()
 
         pending_type = st.session_state.question_type
         continuation_prompt = None
@@ -1970,6 +2691,7 @@ def page_chat():
                     mark_subtopic_mastered(st.session_state.current_subtopic)
                 
                 st.session_state.messages[-1].metadata = metadata
+                mark_messages_changed(len(st.session_state.messages) - 1)
                 
                 if personality == "Narrative":
                     continuation_prompt = f"The learner answered well and earned {xp_awarded} XP. Continue naturally with the story - acknowledge their answer briefly and move to the next part of the episode or the next episode. DO NOT repeat the question you just asked."
@@ -1978,7 +2700,7 @@ def page_chat():
                 else:
                     continuation_prompt = f"The learner answered correctly and earned {xp_awarded} XP. Provide brief positive feedback and continue with the next quiz question or learning section."
                 
-                save_persisted_state()
+                mark_state_dirty()
             else:
                 if st.session_state.challenge_active:
                     st.toast("Challenge bonus still waiting for a strong answer.", icon="⌛")
@@ -1990,11 +2712,11 @@ def page_chat():
             concept_key = st.session_state.current_concept
             st.session_state.current_topic = derive_topic_label(topic_update, concept_key)
             st.session_state.topic_refresh_counter = 0
-            save_persisted_state()
+            mark_state_dirty()
 
         try:
-            with st.spinner("Tutor is thinking..."):
-                reply = chat_with_tutor(model, personality, query, st.session_state.pdf_file_ref, continuation_prompt)
+            reply = get_tutor_reply(model, personality, query, st.session_state.pdf_file_ref, continuation_prompt,
+                                    echo=query, cacheable=chip_query is not None, flow=chip_flow)
             
             if not reply or reply.strip() == "":
                 st.error("Tutor generated an empty response")
@@ -2039,7 +2761,7 @@ def page_chat():
             if check_learning_point_understanding():
                 st.toast("Learning point mastered!", icon="✓")
         
-        save_persisted_state()
+        mark_state_dirty()
         
         if question_type:
             st.session_state.awaiting_answer = True
@@ -2062,11 +2784,13 @@ def page_chat():
             if st.button("Continue", use_container_width=True, type="primary", key="continue_btn_bottom"):
                 query = "continue"
                 st.session_state.messages.append(Message(role="user", content=query, metadata=None))
-                save_persisted_state()
+                mark_state_dirty()
                 
                 try:
-                    with st.spinner("Tutor is thinking..."):
-                        reply = chat_with_tutor(model, personality, query, st.session_state.pdf_file_ref)
+                    reply = take_prefetched_reply("continue", model, personality, query, st.session_state.pdf_file_ref)
+                    if reply is None:
+                        reply = get_tutor_reply(model, personality, query, st.session_state.pdf_file_ref,
+                                                flow="continue")
                     
                     if not reply or reply.strip() == "":
                         reply = "Let me continue with the next section of our lesson..."
@@ -2086,17 +2810,17 @@ def page_chat():
                     st.session_state.question_type = question_type
                     st.session_state.current_hint_policy = st.session_state.get("hint_policy", "LIGHT_HINTS")
                     st.session_state.hint_given_this_question = False
-                save_persisted_state()
+                mark_state_dirty()
                 st.rerun()
         with col_cont2:
             if st.button("Ready for Quiz", use_container_width=True, key="quiz_btn_bottom"):
                 query = "I'm ready for the quiz"
                 st.session_state.messages.append(Message(role="user", content=query, metadata=None))
-                save_persisted_state()
+                mark_state_dirty()
                 
                 try:
-                    with st.spinner("Preparing quiz..."):
-                        reply = chat_with_tutor(model, personality, query, st.session_state.pdf_file_ref)
+                    reply = get_tutor_reply(model, personality, query, st.session_state.pdf_file_ref,
+                                            spinner_text="Preparing quiz...", flow="quiz")
                     
                     if not reply or reply.strip() == "":
                         reply = "[QUIZ] Question 1: What was the primary purpose of Zhang Qian's mission to the West?"
@@ -2116,11 +2840,12 @@ def page_chat():
                     st.session_state.question_type = question_type
                     st.session_state.current_hint_policy = st.session_state.get("hint_policy", "LIGHT_HINTS")
                     st.session_state.hint_given_this_question = False
-                save_persisted_state()
+                mark_state_dirty()
                 st.rerun()
         with col_cont3:
             if st.button("Reset chat", use_container_width=True, type="secondary"):
                 st.session_state.messages = []
+                st.session_state.messages_offset = 0
                 st.session_state.awaiting_answer = False
                 st.session_state.question_type = None
                 st.session_state.current_topic = get_concept()["title"]
@@ -2134,20 +2859,25 @@ def page_chat():
                 st.session_state.narrative_episode_phase = "setup"
                 st.session_state.message_feedback = {}
                 st.session_state.last_question_asked = None
-                save_persisted_state()
+                mark_state_dirty()
                 st.rerun()
+        last_role = getattr(st.session_state.messages[-1], "role", None)
+        if PREFETCH_REPLIES and last_role == "assistant" and not st.session_state.awaiting_answer:
+            # Nothing was clicked; get the next section ready while the learner reads this one.
+            start_prefetch("continue", model, personality, "continue", st.session_state.pdf_file_ref)
     elif personality == "Narrative" and len(st.session_state.messages) > 1:
         col_ep1, col_ep2, col_ep3 = st.columns([1, 1, 1])
         with col_ep1:
-            current_ep = st.session_state.get("narrative_episode", 1)
             if st.button(f"Next Episode", use_container_width=True, type="primary", key="next_episode_btn"):
-                query = f"I'm ready for Episode {current_ep + 1 if current_ep < 4 else 'the chapter recap'}."
+                query = next_episode_query()
                 st.session_state.messages.append(Message(role="user", content=query, metadata=None))
-                save_persisted_state()
+                mark_state_dirty()
                 
                 try:
-                    with st.spinner("Preparing next episode..."):
-                        reply = chat_with_tutor(model, personality, query, st.session_state.pdf_file_ref)
+                    reply = take_prefetched_reply("next_episode", model, personality, query, st.session_state.pdf_file_ref)
+                    if reply is None:
+                        reply = get_tutor_reply(model, personality, query, st.session_state.pdf_file_ref,
+                                                spinner_text="Preparing next episode...", flow="next_episode")
                     
                     if not reply or reply.strip() == "":
                         reply = "Let me continue with the next episode of our journey..."
@@ -2176,7 +2906,7 @@ def page_chat():
                     st.session_state.question_type = question_type
                     st.session_state.current_hint_policy = st.session_state.get("hint_policy", "LIGHT_HINTS")
                     st.session_state.hint_given_this_question = False
-                save_persisted_state()
+                mark_state_dirty()
                 st.rerun()
         with col_ep2:
             if st.button("Switch to Direct Quiz", use_container_width=True, key="switch_direct_btn"):
@@ -2184,11 +2914,12 @@ def page_chat():
                 st.session_state.chat_session = None
                 st.session_state.intro_sent = False
                 st.toast("Switched to Direct tutor for mastery quiz!", icon="🎯")
-                save_persisted_state()
+                mark_state_dirty()
                 st.rerun()
         with col_ep3:
             if st.button("Reset chat", use_container_width=True, type="secondary"):
                 st.session_state.messages = []
+                st.session_state.messages_offset = 0
                 st.session_state.awaiting_answer = False
                 st.session_state.question_type = None
                 st.session_state.current_topic = get_concept()["title"]
@@ -2202,13 +2933,17 @@ def page_chat():
                 st.session_state.narrative_episode_phase = "setup"
                 st.session_state.message_feedback = {}
                 st.session_state.last_question_asked = None
-                save_persisted_state()
+                mark_state_dirty()
                 st.rerun()
+        last_role = getattr(st.session_state.messages[-1], "role", None)
+        if st.session_state.pop("next_episode_prefetch_wanted", False) and last_role == "assistant":
+            start_prefetch("next_episode", model, personality, next_episode_query(), st.session_state.pdf_file_ref)
     else:
         col_a, col_b = st.columns([1, 2])
         with col_a:
             if st.button("Reset chat", use_container_width=True):
                 st.session_state.messages = []
+                st.session_state.messages_offset = 0
                 st.session_state.awaiting_answer = False
                 st.session_state.question_type = None
                 st.session_state.current_topic = get_concept()["title"]
@@ -2222,7 +2957,7 @@ def page_chat():
                 st.session_state.narrative_episode_phase = "setup"
                 st.session_state.message_feedback = {}
                 st.session_state.last_question_asked = None
-                save_persisted_state()
+                mark_state_dirty()
                 st.rerun()
         with col_b:
             if st.session_state.awaiting_answer:
@@ -2414,6 +3149,93 @@ def apply_styles():
         """, unsafe_allow_html=True)
 
 
+def get_client_id() -> Optional[str]:
+    """Best-effort client address for rate limiting; None if Streamlit doesn't expose one.
+
+    Forwarding headers are only consulted with TUTORQUEST_TRUST_PROXY_HEADERS=1.
+    """
+    context = getattr(st, "context", None)
+    if context is None:
+        return None
+    ip_address = getattr(context, "ip_address", None)
+    if ip_address:
+        return ip_address
+    if not TRUST_PROXY_HEADERS:
+        return None
+    try:
+        headers = context.headers
+        forwarded = headers.get("X-Forwarded-For") or headers.get("X-Real-Ip")
+    except Exception:
+        return None
+    if forwarded:
+        return forwarded.split(",")[0].strip()
+    return None
+
+
+def set_session_cookie(token: Optional[str]):
+    """Queue a remember-me cookie update (None clears it) for write_session_cookie() to send."""
+    st.session_state.pending_session_cookie = token or ""
+
+
+def write_session_cookie():
+    """Set or clear the remember-me cookie in the browser if an update is queued.
+
+    The token lives in a cookie rather than the URL so it doesn't end up
+    in browser history, bookmarks or links copied from the address bar.
+    """
+    if "pending_session_cookie" not in st.session_state:
+        return
+    token = st.session_state.pop("pending_session_cookie")
+    max_age = db.SESSION_TTL_SECONDS if token else 0
+    components.html(f"""
+        <script>
+        const secure = window.parent.location.protocol === "https:" ? "; Secure" : "";
+        window.parent.document.cookie = {json.dumps(f"{SESSION_COOKIE}={token}; Max-Age={max_age}; Path=/; SameSite=Strict")} + secure;
+        </script>
+    """, height=0)
+
+
+def remember_session(user_id: int):
+    """Issue a remember-me token so new browser sessions can resume without a password."""
+    token = db.create_session(user_id)
+    if token:
+        st.session_state.session_token = token
+        set_session_cookie(token)
+
+
+def resume_remembered_session() -> bool:
+    """Sign in from a remember-me token, skipping the password KDF entirely.
+
+    Every resume swaps the token for a new one, so a copied token stops
+    working shortly after its owner's next visit.
+    """
+    token = None
+    context = getattr(st, "context", None)
+    if context is not None:
+        try:
+            token = context.cookies.get(SESSION_COOKIE)
+        except Exception:
+            token = None
+    if not token:
+        return False
+    resumed = db.rotate_session(token)
+    if not resumed:
+        set_session_cookie(None)
+        return False
+    st.session_state.user_id, st.session_state.username, new_token = resumed
+    if new_token:
+        st.session_state.session_token = new_token
+        set_session_cookie(new_token)
+    else:
+        # Another tab rotated this token a moment ago and its cookie already holds the replacement.
+        # Signing out with the old token still revokes the replacement.
+        st.session_state.session_token = token
+    st.session_state.db_state_loaded = False
+    st.session_state.messages_synced = None
+    st.session_state.progress_synced = None
+    return True
+
+
 def show_login_page():
     st.title("Sign in to TutorQuest")
     st.write("Create an account or sign in to persist your progress across devices.")
@@ -2427,24 +3249,36 @@ def show_login_page():
             register = st.form_submit_button("Register")
     
     if login and username and password:
-        user_id = db.authenticate_user(username.strip(), password)
-        if user_id:
+        allowed, retry_after = ratelimit.get_login_limiter().check(username.strip(), get_client_id())
+        user_id = db.authenticate_user(username.strip(), password) if allowed else None
+        if not allowed:
+            st.error(f"Too many sign-in attempts. Please wait {int(retry_after) + 1} seconds and try again.")
+        elif user_id:
             st.session_state.user_id = user_id
             st.session_state.username = username.strip()
             st.session_state.db_state_loaded = False
-            save_persisted_state()
+            st.session_state.messages_synced = None
+            st.session_state.progress_synced = None
+            # Don't save here: the guest session would overwrite the account's stored progress.
+            remember_session(user_id)
             st.success("Signed in successfully")
             st.rerun()
         else:
             st.error("Invalid username or password.")
     
     if register and username and password:
-        created = db.create_user(username.strip(), password)
-        if created:
+        allowed, retry_after = ratelimit.get_login_limiter().check_registration(get_client_id())
+        created = db.create_user(username.strip(), password) if allowed else None
+        if not allowed:
+            st.error(f"Too many new accounts from here. Please wait {int(retry_after) + 1} seconds and try again.")
+        elif created:
             st.session_state.user_id = created
             st.session_state.username = username.strip()
             st.session_state.db_state_loaded = False
-            save_persisted_state()
+            st.session_state.messages_synced = None
+            st.session_state.progress_synced = None
+            mark_state_dirty()
+            remember_session(created)
             st.success("Account created and signed in.")
             st.rerun()
         else:
@@ -2452,6 +3286,15 @@ def show_login_page():
 
 
 def main():
+    try:
+        run_app()
+    finally:
+        # Runs on normal completion and when st.rerun()/st.stop() unwind the script,
+        # so every rerun commits its accumulated changes exactly once.
+        flush_persisted_state()
+
+
+def run_app():
     st.set_page_config(
         page_title="TutorQuest",
         page_icon="🎓",
@@ -2460,22 +3303,39 @@ def main():
     )
     try:
         db.init_db()
+        db.start_session_purger()
     except Exception as e:
         st.error(f"Database initialization failed: {e}")
     
     init_state()
     apply_styles()
 
-    if not st.session_state.get("user_id"):
+    if not st.session_state.get("user_id") and not resume_remembered_session():
+        write_session_cookie()
         show_login_page()
         return
+    write_session_cookie()
 
     if st.session_state.get("user_id") and not st.session_state.get("db_state_loaded"):
         try:
-            state = db.get_user_state(st.session_state["user_id"])
+            # Another session of this user may still have writes queued.
+            persistence.get_writer().flush_user(st.session_state["user_id"], timeout=5)
+            state = persistence.load_user_state(st.session_state["user_id"])
+            logged_messages = db.get_messages(st.session_state["user_id"], limit=HISTORY_PAGE_SIZE)
+            if logged_messages:
+                st.session_state.messages = [
+                    Message(role=m["role"], content=m["content"], metadata=m["metadata"])
+                    for m in logged_messages
+                ]
+                st.session_state.messages_offset = logged_messages[0]["seq"]
+                st.session_state.messages_synced = len(logged_messages)
+            else:
+                st.session_state.messages_offset = 0
+                # Nothing in the message log yet: legacy blobs and local history get appended on the next save.
+                st.session_state.messages_synced = 0
             if isinstance(state, dict):
                 persisted_messages = state.get("messages")
-                if isinstance(persisted_messages, list) and persisted_messages:
+                if not logged_messages and isinstance(persisted_messages, list) and persisted_messages:
                     restored = []
                     for payload in persisted_messages:
                         if not isinstance(payload, dict):
@@ -2500,9 +3360,32 @@ def main():
                              "current_concept", "current_subtopic", "current_topic", "personality", 
                              "challenge_active", "intro_sent", "narrative_episode", "narrative_episode_phase",
                              "hint_policy", "question_depth", "quiz_difficulty", "bandit_stats", "message_feedback"):
-                        st.session_state[k] = v
+                        if k == "bandit_stats" and isinstance(v, dict):
+                            # Reward histories now live in bandit_arms; keep session defaults for missing families.
+                            st.session_state.bandit_stats = {**st.session_state.get("bandit_stats", {}), **v}
+                        else:
+                            st.session_state[k] = v
                 
                 st.session_state.db_state_loaded = True
+
+            progress = db.get_progress(st.session_state["user_id"])
+            for k in ("concept_progress", "subtopic_progress", "learning_point_progress"):
+                merged = dict(st.session_state.get(k) or {})
+                for key, entry in progress[k].items():
+                    if isinstance(merged.get(key), dict):
+                        merged[key] = {**merged[key], **entry}
+                    else:
+                        merged[key] = entry
+                st.session_state[k] = merged
+            bandit_stats = st.session_state.get("bandit_stats", {})
+            for family, arms in progress["bandit_stats"].items():
+                bandit_stats[family] = {**bandit_stats.get(family, {}), **arms}
+            st.session_state.bandit_stats = bandit_stats
+            # Rows already in the tables are the baseline; anything else (e.g. a legacy blob) is written on the next save.
+            st.session_state.progress_synced = db.flatten_progress(progress)
+            # Accounts created before the xp/level columns existed get them filled in from state.
+            st.session_state.xp_column_stale = True
+            mark_state_dirty()
         except Exception as e:
             st.error(f"Error loading saved state: {e}")
 
@@ -0,0 +1,520 @@
+"""Microbenchmarks for TutorQuest's persistence layer.
+
+Run every benchmark with ``python bench.py`` or a single one by name,
+e.g. ``python bench.py db_concurrency``. Benchmarks use throwaway
+databases in a temp directory and never touch tutorquest.db.
+"""
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict
+
+import db
+
+BENCHMARKS: Dict[str, Callable[[], None]] = {}
+
+
+def benchmark(fn: Callable[[], None]) -> Callable[[], None]:
+    BENCHMARKS[fn.__name__] = fn
+    return fn
+
+
+@contextmanager
+def temp_database():
+    """Point db at a fresh database file for the duration of a benchmark."""
+    original = db.DB_PATH
+    with tempfile.TemporaryDirectory() as tmp:
+        db.DB_PATH = os.path.join(tmp, "bench.db")
+        try:
+            db.init_db()
+            yield db.DB_PATH
+        finally:
+            db.close_connections()
+            db.DB_PATH = original
+
+
+@contextmanager
+def unpooled_connections():
+    """Swap in the pre-pool behaviour: a new rollback-journal connection per call."""
+    get_conn, release_conn = db._get_conn, db._release_conn
+    db._get_conn = lambda: sqlite3.connect(db.DB_PATH, check_same_thread=False)
+    db._release_conn = lambda conn: conn.close()
+    try:
+        yield
+    finally:
+        db._get_conn, db._release_conn = get_conn, release_conn
+
+
+def sample_state(turns: int = 20) -> Dict:
+    return {
+        "xp": 120,
+        "level": 2,
+        "personality": "Socratic",
+        "learning_point_progress": {"origins_expansion": {"lp_0": "completed", "lp_1": "active"}},
+        "notes": ["Learner answered a mini-question about the Han Dynasty." for _ in range(turns)],
+    }
+
+
+def run_sessions(sessions: int, rounds: int) -> float:
+    """Simulate concurrent learners each saving then reloading state; returns ops/sec."""
+    user_ids = [db.create_user(f"bench_{i}_{time.time_ns()}", "pw") for i in range(sessions)]
+    state = sample_state()
+    errors = []
+    barrier = threading.Barrier(sessions)
+
+    def worker(user_id: int):
+        barrier.wait()
+        for _ in range(rounds):
+            if not db.save_user_state(user_id, state):
+                errors.append(user_id)
+            db.get_user_state(user_id)
+
+    threads = [threading.Thread(target=worker, args=(uid,)) for uid in user_ids]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    if errors:
+        print(f"    {len(errors)} failed saves")
+    return (sessions * rounds * 2) / elapsed
+
+
+@benchmark
+def db_concurrency(sessions: int = 50, rounds: int = 40):
+    """Save/load throughput for 50 concurrent sessions, fresh connections vs. the WAL pool."""
+    print(f"db_concurrency: {sessions} sessions x {rounds} save+load rounds")
+    with temp_database():
+        with unpooled_connections():
+            # WAL mode sticks to the file once set, so start the baseline on a rollback journal.
+            db.close_connections()
+            conn = sqlite3.connect(db.DB_PATH)
+            conn.execute("PRAGMA journal_mode=DELETE")
+            conn.close()
+            baseline = run_sessions(sessions, rounds)
+    with temp_database():
+        pooled = run_sessions(sessions, rounds)
+    print(f"  per-call connections: {baseline:10.0f} ops/s")
+    print(f"  pooled WAL:           {pooled:10.0f} ops/s  ({pooled / baseline:.1f}x)")
+
+
+REPLY_SENTENCES = [
+    "Zhang Qian's mission began as a search for allies against the Xiongnu.",
+    "He was captured twice and spent over a decade away from Chang'an.",
+    "His reports described Ferghana's 'heavenly horses' and the markets of Bactria.",
+    "Emperor Wu used them to plan garrisons along the Hexi Corridor.",
+    "Sogdian merchants acted as middlemen between oasis cities.",
+    "Caravanserais spaced a day's ride apart made desert crossings survivable.",
+    "Buddhist monks travelled with caravans and founded cave temples at Dunhuang.",
+    "Silk worked as both a luxury good and a currency for paying frontier troops.",
+    "Parthian traders guarded their position by withholding routes from Rome.",
+    "Paper-making reached Samarkand after the Battle of Talas in 751 CE.",
+]
+
+
+def sample_reply(rng: random.Random) -> str:
+    paragraphs = [" ".join(rng.sample(REPLY_SENTENCES, 3)) for _ in range(2)]
+    bullets = "\n".join(f"- {s}" for s in rng.sample(REPLY_SENTENCES, 3))
+    question = rng.choice(REPLY_SENTENCES).rstrip(".") + " - why did that matter?"
+    return f"Great thinking, learner #{rng.randint(1, 10_000)}!\n\n" + "\n\n".join(paragraphs) + \
+        f"\n\n{bullets}\n\n**Mini-Question:** {question}"
+
+
+def sample_transcript(turns: int):
+    rng = random.Random(turns)
+    messages = []
+    for i in range(turns):
+        messages.append({"role": "user", "content": f"I think the envoy's reports mattered because of trade #{i}.", "metadata": None})
+        messages.append({
+            "role": "assistant",
+            "content": sample_reply(rng),
+            "metadata": {"question_type": "mini", "hint_policy": "LIGHT_HINTS", "personality": "Socratic"},
+        })
+    return messages
+
+
+def time_call(fn, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+@benchmark
+def state_codec(repeat: int = 20):
+    """Encode/decode time and stored size of a state blob for growing conversations."""
+    print("state_codec: state + transcript, per-format size and timings")
+    print(f"  {'turns':>5} {'format':>6} {'bytes':>9} {'ratio':>6} {'encode ms':>10} {'decode ms':>10}")
+    formats = (("json", db.FORMAT_RAW), ("zlib", db.FORMAT_ZLIB), ("lzma", db.FORMAT_LZMA))
+    for turns in (10, 100, 500):
+        state = sample_state()
+        state["messages"] = sample_transcript(turns)
+        raw_size = len(db.encode_state(state, db.FORMAT_RAW))
+        for label, fmt in formats:
+            encoded = db.encode_state(state, fmt)
+            encode_ms = time_call(lambda: db.encode_state(state, fmt), repeat)
+            decode_ms = time_call(lambda: db.decode_state(encoded), repeat)
+            print(f"  {turns:>5} {label:>6} {len(encoded):>9} {raw_size / len(encoded):>5.1f}x "
+                  f"{encode_ms:>10.2f} {decode_ms:>10.2f}")
+
+
+@benchmark
+def login_throughput(clients: int = 16, attempts: int = 2):
+    """Concurrent sign-ins through the bounded KDF pool, per password scheme."""
+    print(f"login_throughput: {clients} concurrent clients x {attempts} sign-ins, {db.HASH_WORKERS} KDF workers")
+    original_scheme = db.PASSWORD_SCHEME
+    try:
+        for scheme in ("pbkdf2_sha256", "scrypt"):
+            db.PASSWORD_SCHEME = scheme
+            with temp_database():
+                names = [f"learner_{i}" for i in range(clients)]
+                for name in names:
+                    db.create_user(name, "correct horse")
+                latencies = []
+                lock = threading.Lock()
+                barrier = threading.Barrier(clients)
+
+                def client(name: str):
+                    barrier.wait()
+                    for _ in range(attempts):
+                        start = time.perf_counter()
+                        ok = db.authenticate_user(name, "correct horse")
+                        with lock:
+                            latencies.append((time.perf_counter() - start, ok))
+
+                threads = [threading.Thread(target=client, args=(name,)) for name in names]
+                start = time.perf_counter()
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+                elapsed = time.perf_counter() - start
+                times = sorted(t for t, _ in latencies)
+                failures = sum(1 for _, ok in latencies if not ok)
+                p50 = times[len(times) // 2] * 1000
+                p95 = times[int(len(times) * 0.95) - 1] * 1000
+                print(f"  {scheme:>14}: {len(times) / elapsed:6.1f} logins/s  p50 {p50:7.0f} ms  "
+                      f"p95 {p95:7.0f} ms  failures {failures}")
+    finally:
+        db.PASSWORD_SCHEME = original_scheme
+
+
+@benchmark
+def response_cache(learners: int = 30, model_latency: float = 0.2):
+    """Cold opens for a class hitting the same intro prompt, with and without the response cache."""
+    import response_cache as rc
+    print(f"response_cache: {learners} learners opening the same intro, {model_latency * 1000:.0f} ms per model call")
+    key = "intro:" + str(time.time_ns())
+    calls = 0
+
+    def generate() -> str:
+        nonlocal calls
+        calls += 1
+        time.sleep(model_latency)
+        return sample_reply(random.Random(calls))
+
+    with temp_database():
+        for label, cache in (("uncached", None), ("cached", rc.ResponseCache())):
+            calls = 0
+            start = time.perf_counter()
+            for _ in range(learners):
+                reply = cache.get(key) if cache else None
+                if reply is None:
+                    reply = generate()
+                    if cache:
+                        cache.put(key, reply)
+            elapsed = time.perf_counter() - start
+            print(f"  {label:>8}: {calls:3d} model calls  {elapsed / learners * 1000:7.1f} ms avg open")
+            if cache:
+                stats = cache.stats()
+                print(f"            hit rate {stats['hit_rate']:.0%} "
+                      f"({stats['memory_hits']} memory, {stats['disk_hits']} disk)")
+
+
+# Gemini bills each PDF page as a fixed number of tokens, whatever its text.
+TOKENS_PER_PDF_PAGE = 258
+CHARS_PER_TOKEN = 4
+PASSAGE_QUERIES = [
+    "Why did Zhang Qian travel west and what did he report about Ferghana?",
+    "How did caravanserais and oasis cities support merchants?",
+    "What role did Buddhist monks play along the routes?",
+    "How did paper-making spread after the Battle of Talas?",
+]
+
+
+def sample_curriculum(pages: int, words_per_page: int = 450):
+    rng = random.Random(pages)
+    filler = "trade route empire dynasty merchant caravan tribute garrison frontier market currency".split()
+    result = []
+    for _ in range(pages):
+        words = []
+        while len(words) < words_per_page:
+            words.extend(rng.choice(REPLY_SENTENCES).split())
+            words.extend(rng.sample(filler, 3))
+        result.append(" ".join(words[:words_per_page]))
+    return result
+
+
+@benchmark
+def pdf_passages(pages: int = 39, repeat: int = 200):
+    """Per-turn input tokens and retrieval time, top-k passages vs. attaching the whole PDF."""
+    import pdf_index
+    print(f"pdf_passages: {pages}-page curriculum, top {pdf_index.TOP_K} passages per turn")
+    pages_text = None
+    curriculum = Path(__file__).with_name("Unit 2_ 2.1-2.7.pdf")
+    if curriculum.exists():
+        extracted = pdf_index.extract_pages(str(curriculum))
+        if pdf_index.PdfReader is None:
+            print(f"  {curriculum.name}: pypdf not installed, using synthetic pages")
+        elif not any(p.strip() for p in extracted):
+            print(f"  {curriculum.name}: no text layer (scanned), so the app keeps sending the full PDF; using synthetic pages")
+        else:
+            pages_text = extracted
+    pages_text = pages_text or sample_curriculum(pages)
+
+    start = time.perf_counter()
+    index = pdf_index.BM25Index(pdf_index.chunk_pages(pages_text))
+    build_ms = (time.perf_counter() - start) * 1000
+    search_ms = time_call(lambda: [index.search(q) for q in PASSAGE_QUERIES], repeat) / len(PASSAGE_QUERIES)
+
+    full_tokens = len(pages_text) * TOKENS_PER_PDF_PAGE
+    passage_tokens = sum(
+        len(pdf_index.format_passages(index.search(q))) / CHARS_PER_TOKEN for q in PASSAGE_QUERIES
+    ) / len(PASSAGE_QUERIES)
+    print(f"  index build:  {build_ms:8.1f} ms once per PDF ({len(index)} chunks)")
+    print(f"  retrieval:    {search_ms:8.3f} ms per turn")
+    print(f"  full PDF:     {full_tokens:8.0f} input tokens per turn")
+    print(f"  passages:     {passage_tokens:8.0f} input tokens per turn  ({full_tokens / passage_tokens:.0f}x fewer)")
+
+
+@benchmark
+def context_window(turns: int = 200, system_tokens: int = 1500):
+    """Prompt tokens per turn over a long chat, full history vs. rolling summary."""
+    import chat_context as cc
+    print(f"context_window: {turns}-turn chat, budget {cc.CONTEXT_TOKEN_BUDGET} tokens, "
+          f"last {cc.KEEP_RECENT_TURNS} turns verbatim")
+    rng = random.Random(0)
+    history = [(f"I think the envoy's reports mattered because of trade #{i}.", sample_reply(rng)) for i in range(turns)]
+    checkpoints = {10, 25, 50, 100, turns}
+    full_tokens = system_tokens
+    summary, recent, compactions = "", [], 0
+    rolling_tokens = system_tokens
+    rebuild_ms = 0.0
+    print(f"  {'turn':>5} {'full history':>13} {'rolling':>9}")
+    for i, turn in enumerate(history, 1):
+        if cc.needs_compaction(rolling_tokens, recent):
+            start = time.perf_counter()
+            summary, recent = cc.compact(summary, recent)
+            cc.history_for(recent)
+            rebuild_ms += (time.perf_counter() - start) * 1000
+            rolling_tokens = system_tokens + cc.estimate_tokens(summary) + cc.turns_tokens(recent)
+            compactions += 1
+        prompt = cc.estimate_tokens(turn[0])
+        if i in checkpoints:
+            print(f"  {i:>5} {full_tokens + prompt:>13} {rolling_tokens + prompt:>9}")
+        turn_tokens = cc.estimate_tokens(turn[0]) + cc.estimate_tokens(turn[1])
+        full_tokens += turn_tokens
+        rolling_tokens += turn_tokens
+        recent.append(turn)
+    print(f"  {compactions} rebuilds, {rebuild_ms / max(compactions, 1):.2f} ms each")
+
+
+@benchmark
+def chat_rehydrate(repeat: int = 50):
+    """Time to rebuild chat history (turn pairing + summary) from a persisted transcript."""
+    import chat_context as cc
+    print(f"chat_rehydrate: persisted transcript -> summary + last {cc.KEEP_RECENT_TURNS} turns")
+    print(f"  {'turns':>5} {'ms':>8} {'history tokens':>15} {'full tokens':>12}")
+    for turns in (10, 100, 500):
+        messages = sample_transcript(turns)
+
+        def rehydrate():
+            summary, recent = cc.compact("", cc.turns_from_messages(messages, "Socratic"))
+            return summary, cc.history_for(recent)
+
+        elapsed_ms = time_call(rehydrate, repeat)
+        summary, history = rehydrate()
+        rebuilt = cc.estimate_tokens(summary) + sum(cc.estimate_tokens(h["parts"][0]) for h in history)
+        full = sum(cc.estimate_tokens(m["content"]) for m in messages)
+        print(f"  {turns:>5} {elapsed_ms:>8.2f} {rebuilt:>15} {full:>12}")
+
+
+class FakeAPIError(Exception):
+    def __init__(self, code: int):
+        super().__init__(f"{code} from fake Gemini")
+        self.code = code
+
+
+class FakeModel:
+    """Stands in for a Gemini call: fixed latency plus injected errors and hangs."""
+
+    def __init__(self, latency: float = 0.01, seed: int = 0):
+        self.latency = latency
+        self.rng = random.Random(seed)
+        self.error_rate = 0.0
+        self.error_codes = (429, 503)
+        self.hang_rate = 0.0
+        self.down = False
+        self.calls = 0
+
+    def __call__(self, timeout: float) -> str:
+        self.calls += 1
+        if self.down:
+            time.sleep(self.latency)
+            raise FakeAPIError(503)
+        if self.rng.random() < self.hang_rate:
+            time.sleep(min(timeout, 1.0))
+            raise TimeoutError("fake Gemini call timed out")
+        time.sleep(self.latency)
+        if self.rng.random() < self.error_rate:
+            raise FakeAPIError(self.rng.choice(self.error_codes))
+        return "ok"
+
+
+@benchmark
+def gemini_faults(requests: int = 200):
+    """Retries, deadlines and the circuit breaker against a fault-injecting fake model."""
+    import llm
+    print("gemini_faults: fake model with injected 429/503s, hangs and an outage")
+    fast_sleep = lambda delay: time.sleep(delay / 100)  # Scale backoff down so the run stays short.
+
+    def run(model, breaker, count, timeout=llm.REQUEST_TIMEOUT_SECONDS):
+        ok = failed = fast_failed = 0
+        start = time.perf_counter()
+        for _ in range(count):
+            try:
+                llm.call_with_retry(model, breaker, timeout=timeout, sleep=fast_sleep)
+                ok += 1
+            except llm.CircuitOpenError:
+                fast_failed += 1
+            except Exception:
+                failed += 1
+        return ok, failed, fast_failed, (time.perf_counter() - start) / count * 1000
+
+    model = FakeModel()
+    model.error_rate = 0.3
+    ok = 0
+    for _ in range(requests):
+        try:
+            model(llm.REQUEST_TIMEOUT_SECONDS)
+            ok += 1
+        except FakeAPIError:
+            pass
+    print(f"  30% errors, no retry: {ok / requests:6.1%} succeeded, {model.calls} model calls")
+    model.calls = 0
+    ok, failed, _, avg_ms = run(model, llm.CircuitBreaker(), requests)
+    print(f"  30% errors,    retry: {ok / requests:6.1%} succeeded, {model.calls} model calls, {avg_ms:.1f} ms avg")
+
+    model = FakeModel()
+    model.hang_rate = 0.2
+    ok, failed, _, avg_ms = run(model, llm.CircuitBreaker(), 50, timeout=0.05)
+    print(f"  20% hangs, 50 ms timeout: {ok / 50:6.1%} succeeded, {avg_ms:.1f} ms avg")
+
+    breaker = llm.CircuitBreaker(failure_threshold=5, cooldown_seconds=0.2)
+    model = FakeModel()
+    model.down = True
+    ok, failed, fast_failed, avg_ms = run(model, breaker, requests)
+    print(f"  outage: {model.calls} model calls for {requests} requests, {fast_failed} failed fast, "
+          f"{avg_ms:.2f} ms avg, breaker {breaker.state}")
+    model.down = False
+    time.sleep(breaker.cooldown_seconds)
+    ok, failed, fast_failed, _ = run(model, breaker, 20)
+    print(f"  recovery after cooldown: {ok}/20 succeeded, breaker {breaker.state}")
+
+
+@benchmark
+def continue_prefetch(turns: int = 40, generation: float = 0.3, reading: float = 0.4, continue_rate: float = 0.7):
+    """Perceived Continue latency and wasted tokens with speculative prefetch of the next section."""
+    import prefetch
+    print(f"continue_prefetch: {turns} turns, {generation * 1000:.0f} ms generation, "
+          f"{reading * 1000:.0f} ms reading, learner clicks Continue {continue_rate:.0%} of the time")
+    rng = random.Random(1)
+    tokens_per_reply = 900
+
+    def generate():
+        time.sleep(generation)
+        return sample_reply(rng), tokens_per_reply
+
+    prefetcher = prefetch.Prefetcher()
+    waits = {"without": [], "with": []}
+    for turn in range(turns):
+        entry = prefetcher.submit("continue", str(turn), generate)
+        time.sleep(reading)
+        clicked = rng.random() < continue_rate
+        if clicked:
+            start = time.perf_counter()
+            prefetcher.claim(entry)
+            waits["with"].append(time.perf_counter() - start)
+            waits["without"].append(generation)
+        else:
+            prefetcher.discard(entry)
+    time.sleep(generation)  # Let the last discarded generation finish so its tokens are counted.
+    stats = prefetcher.stats()["continue"]
+    for label in ("without", "with"):
+        avg_ms = sum(waits[label]) / len(waits[label]) * 1000
+        print(f"  {label:>7} prefetch: {avg_ms:7.1f} ms avg wait after Continue")
+    print(f"  hit rate {stats['hit_rate']:.0%}, {stats['ready_hits']}/{stats['hits']} ready on click, "
+          f"{stats['wasted_tokens']} wasted tokens ({stats['discarded']} discarded)")
+
+
+@benchmark
+def single_flight(learners: int = 30, model_latency: float = 0.2):
+    """A whole class sending the same intro at the same moment: response cache alone vs. plus single-flight."""
+    import llm
+    import response_cache as rc
+    print(f"single_flight: {learners} learners open the chat simultaneously, {model_latency * 1000:.0f} ms per call")
+    with temp_database():
+        for label, flights in (("cache only", None), ("cache + single-flight", llm.SingleFlight())):
+            cache = rc.ResponseCache()
+            key = f"intro:{label}:{time.time_ns()}"
+            calls = 0
+            lock = threading.Lock()
+            barrier = threading.Barrier(learners)
+            latencies = []
+
+            def generate() -> str:
+                nonlocal calls
+                with lock:
+                    calls += 1
+                time.sleep(model_latency)
+                return "Welcome to the Silk Road!"
+
+            def learner():
+                barrier.wait()
+                start = time.perf_counter()
+                reply = cache.get(key)
+                if reply is None:
+                    reply = flights.do(key, generate)[0] if flights else generate()
+                    cache.put(key, reply)
+                with lock:
+                    latencies.append(time.perf_counter() - start)
+
+            threads = [threading.Thread(target=learner) for _ in range(learners)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            merged = flights.stats()["merged"] if flights else 0
+            print(f"  {label:>21}: {calls:3d} model calls, {merged:3d} merged, "
+                  f"{max(latencies) * 1000:6.0f} ms slowest open")
+
+
+def main(argv):
+    names = argv or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark '{name}'. Available: {', '.join(BENCHMARKS)}")
+            return 1
+        BENCHMARKS[name]()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,85 @@
+import os
+import re
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Rebuild the chat once its estimated prompt size passes this many tokens.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("TUTORQUEST_CONTEXT_TOKENS", "8000"))
+# Turns (learner message + tutor reply) kept verbatim when older ones are summarized.
+KEEP_RECENT_TURNS = int(os.getenv("TUTORQUEST_KEEP_TURNS", "6"))
+SUMMARY_MAX_LINES = 40
+CHARS_PER_TOKEN = 4
+
+Turn = Tuple[str, str]
+
+_TAG_PATTERN = re.compile(r"\[(?:MINI-Q|QUIZ|SUBTOPIC_COMPLETE|MASTERED episode_\d+)\]")
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def turns_tokens(turns: Sequence[Turn]) -> int:
+    return sum(estimate_tokens(user_text) + estimate_tokens(reply) for user_text, reply in turns)
+
+
+def _clip(text: str, limit: int) -> str:
+    text = " ".join(_TAG_PATTERN.sub("", text).split())
+    return text if len(text) <= limit else text[:limit - 3].rstrip() + "..."
+
+
+def _first_sentence(text: str, limit: int = 180) -> str:
+    text = " ".join(_TAG_PATTERN.sub("", text).replace("*", "").split())
+    match = re.match(r"(.+?[.!?])(?:\s|$)", text)
+    return _clip(match.group(1) if match else text, limit)
+
+
+def fold_summary(summary: str, turns: Sequence[Turn]) -> str:
+    """Append one condensed line per turn to the running summary, keeping its newest lines."""
+    lines = [line for line in summary.splitlines() if line.strip()]
+    for user_text, reply in turns[-SUMMARY_MAX_LINES:]:
+        lines.append(f"- Learner: {_clip(user_text, 120)} | Tutor: {_first_sentence(reply)}")
+    return "\n".join(lines[-SUMMARY_MAX_LINES:])
+
+
+def needs_compaction(tokens: int, turns: Sequence[Turn], budget: int = CONTEXT_TOKEN_BUDGET,
+                     keep: int = KEEP_RECENT_TURNS) -> bool:
+    return len(turns) > keep and tokens > budget
+
+
+def compact(summary: str, turns: Sequence[Turn], keep: int = KEEP_RECENT_TURNS) -> Tuple[str, List[Turn]]:
+    """Fold all but the last `keep` turns into the summary. Returns (summary, recent turns)."""
+    if len(turns) <= keep:
+        return summary, list(turns)
+    return fold_summary(summary, turns[:-keep]), list(turns[-keep:])
+
+
+def turns_from_messages(messages: Sequence[Dict], personality: Optional[str] = None) -> List[Turn]:
+    """Pair persisted messages into (learner, tutor) turns.
+
+    Replies recorded under a different personality are skipped along
+    with the learner messages before them, and a trailing learner
+    message that has no reply yet is left out.
+    """
+    turns = []
+    pending: List[str] = []
+    for message in messages:
+        role, content = message.get("role"), message.get("content") or ""
+        if role == "user":
+            pending.append(content)
+            continue
+        if role != "assistant":
+            continue
+        replied_as = (message.get("metadata") or {}).get("personality")
+        if personality is None or replied_as in (None, personality):
+            turns.append(("\n".join(pending) or "(continue)", content))
+        pending = []
+    return turns
+
+
+def history_for(turns: Sequence[Turn]) -> List[Dict]:
+    """Gemini chat history entries for verbatim turns."""
+    history = []
+    for user_text, reply in turns:
+        history.append({"role": "user", "parts": [user_text]})
+        history.append({"role": "model", "parts": [reply]})
+    return history
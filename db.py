@@ -1,14 +1,144 @@
 import sqlite3
+import copy
 import json
 import os
 import hashlib
+import hmac
+import lzma
+import queue
+import secrets
+import threading
 import time
-from typing import Optional, Dict
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Dict, List, Tuple
+
+DB_PATH = os.environ.get("TUTORQUEST_DB", os.path.join(os.path.dirname(__file__), "tutorquest.db"))
+
+POOL_SIZE = 16
+BUSY_TIMEOUT_MS = 5000
+CACHE_SIZE_KIB = 8192
+
+_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}",
+    f"PRAGMA cache_size=-{CACHE_SIZE_KIB}",
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+class _ConnectionPool:
+    """Keeps up to max_idle open connections per database file and hands them out to any thread."""
+
+    def __init__(self, path: str, max_idle: int):
+        self.path = path
+        self._idle = queue.LifoQueue(maxsize=max_idle)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, timeout=BUSY_TIMEOUT_MS / 1000)
+        for pragma in _PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, conn: sqlite3.Connection):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            self._idle.put_nowait(conn)
+        except (queue.Full, sqlite3.Error):
+            conn.close()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_pools: Dict[str, _ConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool() -> _ConnectionPool:
+    pool = _pools.get(DB_PATH)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(DB_PATH)
+            if pool is None:
+                pool = _ConnectionPool(DB_PATH, POOL_SIZE)
+                _pools[DB_PATH] = pool
+    return pool
+
+
+# Encoded payloads start with a format byte. Rows written before the codec
+# existed are plain TEXT and are decoded as-is.
+FORMAT_RAW = 0x00
+FORMAT_ZLIB = 0x01
+FORMAT_LZMA = 0x02
+STATE_FORMAT = FORMAT_ZLIB
+# Short message contents don't shrink enough to be worth the format byte and CPU.
+COMPRESS_MIN_BYTES = 256
+
+
+def encode_payload(text: str, fmt: int = None) -> bytes:
+    fmt = STATE_FORMAT if fmt is None else fmt
+    raw = text.encode("utf-8")
+    if fmt == FORMAT_ZLIB:
+        return bytes([FORMAT_ZLIB]) + zlib.compress(raw, 6)
+    if fmt == FORMAT_LZMA:
+        return bytes([FORMAT_LZMA]) + lzma.compress(raw, preset=1)
+    return bytes([FORMAT_RAW]) + raw
+
+
+def decode_payload(payload) -> str:
+    if isinstance(payload, str):
+        return payload
+    payload = bytes(payload)
+    fmt, body = payload[0], payload[1:]
+    if fmt == FORMAT_ZLIB:
+        return zlib.decompress(body).decode("utf-8")
+    if fmt == FORMAT_LZMA:
+        return lzma.decompress(body).decode("utf-8")
+    if fmt == FORMAT_RAW:
+        return body.decode("utf-8")
+    raise ValueError(f"Unknown payload format byte: {fmt}")
+
+
+def encode_state(state: Dict, fmt: int = None) -> bytes:
+    return encode_payload(json.dumps(state, separators=(",", ":")), fmt)
+
+
+def decode_state(payload) -> Dict:
+    return json.loads(decode_payload(payload))
+
+
+def _encode_content(content: str):
+    if len(content) < COMPRESS_MIN_BYTES:
+        return content
+    return encode_payload(content)
 
-DB_PATH = os.path.join(os.path.dirname(__file__), "tutorquest.db")
 
 def _get_conn():
-    return sqlite3.connect(DB_PATH, check_same_thread=False)
+    return _get_pool().acquire()
+
+def _release_conn(conn: sqlite3.Connection):
+    _get_pool().release(conn)
+
+def close_connections():
+    """Close idle pooled connections, e.g. before deleting or swapping the database file."""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close_all()
+        _pools.clear()
 
 def init_db():
     conn = _get_conn()
@@ -23,29 +153,218 @@ def init_db():
         last_seen INTEGER
     )
     """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS messages (
+        user_id INTEGER NOT NULL,
+        seq INTEGER NOT NULL,
+        role TEXT NOT NULL,
+        content TEXT NOT NULL,
+        metadata TEXT,
+        created_at INTEGER,
+        PRIMARY KEY (user_id, seq)
+    )
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS concept_progress (
+        user_id INTEGER NOT NULL,
+        concept_key TEXT NOT NULL,
+        unlocked INTEGER NOT NULL DEFAULT 0,
+        mastered INTEGER NOT NULL DEFAULT 0,
+        updated_at INTEGER,
+        PRIMARY KEY (user_id, concept_key)
+    )
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS subtopic_progress (
+        user_id INTEGER NOT NULL,
+        subtopic_key TEXT NOT NULL,
+        unlocked INTEGER NOT NULL DEFAULT 0,
+        mastered INTEGER NOT NULL DEFAULT 0,
+        updated_at INTEGER,
+        PRIMARY KEY (user_id, subtopic_key)
+    )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_subtopic_progress_mastered ON subtopic_progress (subtopic_key, mastered)")
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS learning_point_progress (
+        user_id INTEGER NOT NULL,
+        subtopic_key TEXT NOT NULL,
+        lp_key TEXT NOT NULL,
+        status TEXT NOT NULL,
+        updated_at INTEGER,
+        PRIMARY KEY (user_id, subtopic_key, lp_key)
+    )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_lp_progress_status ON learning_point_progress (subtopic_key, lp_key, status)")
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS bandit_arms (
+        user_id INTEGER NOT NULL,
+        family TEXT NOT NULL,
+        arm TEXT NOT NULL,
+        rewards TEXT NOT NULL,
+        updated_at INTEGER,
+        PRIMARY KEY (user_id, family, arm)
+    )
+    """)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS xp_events (
+        user_id INTEGER NOT NULL,
+        amount INTEGER NOT NULL,
+        created_at INTEGER NOT NULL
+    )
+    """)
+    # Covers the weekly leaderboard's aggregation so it never touches the table itself.
+    _ensure_index(c, "idx_xp_events_created", "xp_events", ("created_at", "user_id", "amount"))
+    c.execute("CREATE INDEX IF NOT EXISTS idx_xp_events_user ON xp_events (user_id, created_at)")
+    # XP and level are materialized from state_json so rankings never have to parse blobs.
+    _ensure_column(c, "users", "xp", "INTEGER NOT NULL DEFAULT 0")
+    _ensure_column(c, "users", "level", "INTEGER NOT NULL DEFAULT 1")
+    # Bumped on every state_json write so local copies of it can tell whether they're current.
+    _ensure_column(c, "users", "state_version", "INTEGER NOT NULL DEFAULT 0")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_xp ON users (xp DESC, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users (last_seen)")
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS sessions (
+        token_hash TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        created_at INTEGER NOT NULL,
+        expires_at INTEGER NOT NULL
+    )
+    """)
+    # Hash of the token a session was rotated into; set while the old token is in its grace period.
+    _ensure_column(c, "sessions", "replaced_by", "TEXT")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)")
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS response_cache (
+        cache_key TEXT NOT NULL,
+        variant INTEGER NOT NULL,
+        content BLOB NOT NULL,
+        created_at INTEGER NOT NULL,
+        PRIMARY KEY (cache_key, variant)
+    )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_created ON response_cache (created_at)")
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS llm_usage (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        created_at INTEGER NOT NULL,
+        user_id INTEGER,
+        personality TEXT,
+        flow TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        source TEXT NOT NULL,
+        model TEXT,
+        ok INTEGER NOT NULL,
+        wall_ms REAL NOT NULL,
+        ttft_ms REAL,
+        prompt_tokens INTEGER NOT NULL DEFAULT 0,
+        response_tokens INTEGER NOT NULL DEFAULT 0,
+        system_tokens_est INTEGER NOT NULL DEFAULT 0,
+        history_tokens_est INTEGER NOT NULL DEFAULT 0,
+        attachment_tokens_est INTEGER NOT NULL DEFAULT 0
+    )
+    """)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_llm_usage_created ON llm_usage (created_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_llm_usage_user ON llm_usage (user_id, created_at)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_llm_usage_flow ON llm_usage (flow, created_at)")
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS pdf_uploads (
+        sha256 TEXT PRIMARY KEY,
+        file_name TEXT NOT NULL,
+        expires_at INTEGER NOT NULL,
+        created_at INTEGER NOT NULL
+    )
+    """)
     conn.commit()
-    conn.close()
+    _release_conn(conn)
+
+def _ensure_column(c: sqlite3.Cursor, table: str, column: str, decl: str):
+    c.execute(f"PRAGMA table_info({table})")
+    if column not in {row[1] for row in c.fetchall()}:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+def _ensure_index(c: sqlite3.Cursor, name: str, table: str, columns: Tuple[str, ...]):
+    """Create an index, rebuilding it if an older version has different columns."""
+    c.execute(f"PRAGMA index_info({name})")
+    existing = tuple(row[2] for row in c.fetchall())
+    if existing == columns:
+        return
+    if existing:
+        c.execute(f"DROP INDEX {name}")
+    c.execute(f"CREATE INDEX {name} ON {table} ({', '.join(columns)})")
+
+# Password hashes are "<scheme>$<params>$<salt hex>$<key hex>" so the KDF and its cost can
+# change later; anything stored with different settings is re-hashed on the next login.
+# Hashes from before this format ("<salt hex>$<key hex>") are PBKDF2-SHA256 at 100k rounds.
+PASSWORD_SCHEME = "pbkdf2_sha256"
+SCRYPT_PARAMS = {"n": 2 ** 14, "r": 8, "p": 1}
+PBKDF2_ITERATIONS = 100_000
+# KDF calls release the GIL, so a small pool bounds how many cores a burst of logins can take.
+HASH_WORKERS = max(2, (os.cpu_count() or 2) // 2)
+HASH_TIMEOUT_SECONDS = 30
+
+_hash_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="tutorquest-kdf")
+
+
+def _current_params() -> str:
+    if PASSWORD_SCHEME == "scrypt":
+        return ",".join(f"{k}={v}" for k, v in SCRYPT_PARAMS.items())
+    return str(PBKDF2_ITERATIONS)
+
+
+def _derive(scheme: str, params: str, password: str, salt: bytes) -> bytes:
+    if scheme == "scrypt":
+        opts = {k: int(v) for k, v in (item.split("=") for item in params.split(","))}
+        return hashlib.scrypt(password.encode("utf-8"), salt=salt, n=opts["n"], r=opts["r"], p=opts["p"],
+                              maxmem=128 * opts["r"] * opts["n"] * 2, dklen=32)
+    if scheme == "pbkdf2_sha256":
+        return hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, int(params))
+    raise ValueError(f"Unknown password scheme: {scheme}")
+
+
+def _parse_hash(stored: str) -> Tuple[str, str, bytes, bytes]:
+    parts = stored.split("$")
+    if len(parts) == 2:
+        salt_hex, dk_hex = parts
+        return "pbkdf2_sha256", "100000", bytes.fromhex(salt_hex), bytes.fromhex(dk_hex)
+    scheme, params, salt_hex, dk_hex = parts
+    return scheme, params, bytes.fromhex(salt_hex), bytes.fromhex(dk_hex)
+
 
 def _hash_password(password: str, salt: Optional[bytes] = None) -> str:
     if salt is None:
         salt = os.urandom(16)
-    dk = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, 100_000)
-    return salt.hex() + "$" + dk.hex()
+    params = _current_params()
+    dk = _derive(PASSWORD_SCHEME, params, password, salt)
+    return f"{PASSWORD_SCHEME}${params}${salt.hex()}${dk.hex()}"
 
 def _verify_password(stored: str, password: str) -> bool:
     try:
-        salt_hex, dk_hex = stored.split("$")
-        salt = bytes.fromhex(salt_hex)
-        dk = hashlib.pbkdf2_hmac("sha256", password.encode("utf-8"), salt, 100_000)
-        return dk.hex() == dk_hex
+        scheme, params, salt, expected = _parse_hash(stored)
+        return hmac.compare_digest(_derive(scheme, params, password, salt), expected)
     except Exception:
         return False
 
+def _needs_rehash(stored: str) -> bool:
+    try:
+        scheme, params, _, _ = _parse_hash(stored)
+    except Exception:
+        return True
+    legacy_format = stored.count("$") == 1
+    return legacy_format or scheme != PASSWORD_SCHEME or params != _current_params()
+
+def _run_kdf(fn, *args):
+    """Run a hashing call on the KDF pool and wait for it."""
+    return _hash_executor.submit(fn, *args).result(timeout=HASH_TIMEOUT_SECONDS)
+
 def create_user(username: str, password: str) -> Optional[int]:
+    try:
+        pwd = _run_kdf(_hash_password, password)
+    except Exception:
+        return None
     conn = _get_conn()
     c = conn.cursor()
     try:
-        pwd = _hash_password(password)
         now = int(time.time())
         c.execute("INSERT INTO users (username, password_hash, created_at, last_seen) VALUES (?, ?, ?, ?)",
                   (username, pwd, now, now))
@@ -55,7 +374,7 @@ def create_user(username: str, password: str) -> Optional[int]:
     except Exception:
         return None
     finally:
-        conn.close()
+        _release_conn(conn)
 
 def authenticate_user(username: str, password: str) -> Optional[int]:
     conn = _get_conn()
@@ -63,40 +382,749 @@ def authenticate_user(username: str, password: str) -> Optional[int]:
     try:
         c.execute("SELECT id, password_hash FROM users WHERE username = ?", (username,))
         row = c.fetchone()
-        if not row:
+    finally:
+        # Don't hold a pooled connection while the KDF runs.
+        _release_conn(conn)
+    if not row:
+        return None
+    user_id, stored = row
+    try:
+        if not _run_kdf(_verify_password, stored, password):
             return None
-        user_id, stored = row
-        if _verify_password(stored, password):
+        upgraded = _run_kdf(_hash_password, password) if _needs_rehash(stored) else None
+    except Exception:
+        return None
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        if upgraded:
+            c.execute("UPDATE users SET password_hash = ?, last_seen = ? WHERE id = ? AND password_hash = ?",
+                      (upgraded, int(time.time()), user_id, stored))
+        else:
             c.execute("UPDATE users SET last_seen = ? WHERE id = ?", (int(time.time()), user_id))
-            conn.commit()
-            return user_id
+        conn.commit()
+    except Exception:
+        pass
+    finally:
+        _release_conn(conn)
+    return user_id
+
+SESSION_TTL_SECONDS = 30 * 24 * 3600
+SESSION_PURGE_INTERVAL_SECONDS = 3600
+# How long a rotated token keeps working, so tabs that sent it alongside the winning one stay signed in.
+SESSION_ROTATION_GRACE_SECONDS = 60
+
+def _token_hash(token: str) -> str:
+    # Tokens are 256-bit random values, so a plain SHA-256 is enough; no KDF needed.
+    return hashlib.sha256(token.encode("utf-8")).hexdigest()
+
+def create_session(user_id: int, ttl_seconds: int = SESSION_TTL_SECONDS) -> Optional[str]:
+    """Issue a remember-me token; only its hash is stored."""
+    token = secrets.token_urlsafe(32)
+    now = int(time.time())
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        c.execute("INSERT INTO sessions (token_hash, user_id, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                  (_token_hash(token), user_id, now, now + ttl_seconds))
+        conn.commit()
+        return token
+    except Exception:
+        return None
+    finally:
+        _release_conn(conn)
+
+def rotate_session(
+    token: str, ttl_seconds: int = SESSION_TTL_SECONDS, grace_seconds: int = SESSION_ROTATION_GRACE_SECONDS
+) -> Optional[Tuple[int, str, Optional[str]]]:
+    """Exchange a live token for a fresh one; returns (user_id, username, new token).
+
+    The old token only keeps working for grace_seconds, so one that
+    leaked (a copied cookie) is only good until shortly after its
+    owner's next visit. Presenting a token that another tab already
+    rotated, within that grace period, returns a new token of None:
+    the caller is signed in but should leave the cookie alone, since it
+    already holds the replacement. Unknown or expired tokens give None.
+    """
+    if not token:
         return None
+    now = int(time.time())
+    old_hash = _token_hash(token)
+    new_token = secrets.token_urlsafe(32)
+    new_hash = _token_hash(new_token)
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        c.execute("""
+            SELECT s.user_id, u.username, s.replaced_by FROM sessions s JOIN users u ON u.id = s.user_id
+            WHERE s.token_hash = ? AND s.expires_at > ?
+        """, (old_hash, now))
+        row = c.fetchone()
+        if not row:
+            return None
+        user_id, username, replaced_by = row
+        if replaced_by is not None:
+            return user_id, username, None
+        c.execute("""
+            UPDATE sessions SET replaced_by = ?, expires_at = MIN(expires_at, ?)
+            WHERE token_hash = ? AND replaced_by IS NULL
+        """, (new_hash, now + grace_seconds, old_hash))
+        if c.rowcount != 1:
+            # Another tab rotated (or signed out) between our read and write; find out which.
+            conn.rollback()
+            c.execute("SELECT replaced_by FROM sessions WHERE token_hash = ? AND expires_at > ?", (old_hash, now))
+            row = c.fetchone()
+            return (user_id, username, None) if row and row[0] is not None else None
+        c.execute("INSERT INTO sessions (token_hash, user_id, created_at, expires_at) VALUES (?, ?, ?, ?)",
+                  (new_hash, user_id, now, now + ttl_seconds))
+        c.execute("UPDATE users SET last_seen = ? WHERE id = ?", (now, user_id))
+        conn.commit()
+        return user_id, username, new_token
+    except Exception:
+        conn.rollback()
+        return None
+    finally:
+        _release_conn(conn)
+
+def revoke_session(token: str):
+    """Delete a session along with any tokens it was rotated into."""
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        c.execute("""
+            WITH RECURSIVE chain(token_hash) AS (
+                SELECT ?
+                UNION
+                SELECT s.replaced_by FROM sessions s JOIN chain ON s.token_hash = chain.token_hash
+                WHERE s.replaced_by IS NOT NULL
+            )
+            DELETE FROM sessions WHERE token_hash IN chain
+        """, (_token_hash(token),))
+        conn.commit()
+    except Exception:
+        pass
+    finally:
+        _release_conn(conn)
+
+def purge_expired_sessions() -> int:
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        c.execute("DELETE FROM sessions WHERE expires_at <= ?", (int(time.time()),))
+        conn.commit()
+        return c.rowcount
+    except Exception:
+        return 0
     finally:
-        conn.close()
+        _release_conn(conn)
+
+_session_purger: Optional[threading.Thread] = None
+_session_purger_lock = threading.Lock()
+
+def start_session_purger(interval: float = SESSION_PURGE_INTERVAL_SECONDS):
+    """Start (once per process) a daemon thread that deletes expired sessions and old XP events in bulk."""
+    global _session_purger
+    with _session_purger_lock:
+        if _session_purger is not None and _session_purger.is_alive():
+            return
+
+        def run():
+            while True:
+                purge_expired_sessions()
+                purge_xp_events()
+                time.sleep(interval)
+
+        _session_purger = threading.Thread(target=run, name="tutorquest-session-purger", daemon=True)
+        _session_purger.start()
+
+class _StateCache:
+    """LRU of decoded user state, bounded by the size of the states' JSON text.
+
+    Every state is put with the users.state_version it was read or
+    written at, and the cache remembers the newest version it has seen
+    per user, so a slow reader or writer can't reinsert a state that
+    has since been overwritten, even after the newer entry was evicted.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "OrderedDict[int, Tuple[Dict, int]]" = OrderedDict()
+        self._versions: Dict[int, int] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int) -> Optional[Dict]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            state = entry[0]
+        return copy.deepcopy(state)
+
+    def put(self, user_id: int, state: Dict, size: int, version: int):
+        with self._lock:
+            if version < self._versions.get(user_id, 0):
+                return
+            self._versions[user_id] = version
+            self._discard(user_id)
+            if size > self.max_bytes:
+                return
+            self._entries[user_id] = (copy.deepcopy(state), size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._discard(user_id)
+
+    def _discard(self, user_id: int):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+STATE_CACHE_BYTES = 64 * 1024 * 1024
+_state_cache = _StateCache(STATE_CACHE_BYTES)
+
+def state_cache_stats() -> Dict:
+    return _state_cache.stats()
 
 def get_user_state(user_id: int) -> Optional[Dict]:
+    cached = _state_cache.get(user_id)
+    if cached is not None:
+        return cached
     conn = _get_conn()
     c = conn.cursor()
     try:
-        c.execute("SELECT state_json FROM users WHERE id = ?", (user_id,))
+        c.execute("SELECT state_json, state_version FROM users WHERE id = ?", (user_id,))
         row = c.fetchone()
         if not row or row[0] is None:
             return None
-        return json.loads(row[0])
+        text = decode_payload(row[0])
+        state = json.loads(text)
+        _state_cache.put(user_id, state, len(text), row[1])
+        return state
     except Exception:
         return None
     finally:
-        conn.close()
+        _release_conn(conn)
+
+def get_state_version(user_id: int) -> Optional[int]:
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        c.execute("SELECT state_version FROM users WHERE id = ?", (user_id,))
+        row = c.fetchone()
+        return row[0] if row else None
+    except Exception:
+        return None
+    finally:
+        _release_conn(conn)
+
+def _write_state(c: sqlite3.Cursor, user_id: int, state: Dict, now: int) -> Tuple[int, int]:
+    """Stage a state write; returns the size of its JSON text (the cache's unit of account) and its new version."""
+    _state_cache.invalidate(user_id)
+    text = json.dumps(state, separators=(",", ":"))
+    c.execute("UPDATE users SET state_json = ?, last_seen = ?, state_version = state_version + 1 WHERE id = ?",
+              (encode_payload(text), now, user_id))
+    c.execute("SELECT state_version FROM users WHERE id = ?", (user_id,))
+    row = c.fetchone()
+    return len(text), row[0] if row else 0
+
+def _write_messages(c: sqlite3.Cursor, user_id: int, start_seq: int, messages: List[Dict], now: int):
+    rows = [
+        (user_id, start_seq + offset, m["role"], _encode_content(m["content"]),
+         json.dumps(m.get("metadata")) if m.get("metadata") is not None else None, now)
+        for offset, m in enumerate(messages)
+    ]
+    c.execute("DELETE FROM messages WHERE user_id = ? AND seq >= ?", (user_id, start_seq))
+    c.executemany("INSERT INTO messages (user_id, seq, role, content, metadata, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                  rows)
+
+# Bandit families stored one row per arm; anything else in bandit_stats stays in state_json.
+BANDIT_FAMILIES = (
+    "hint_policy_rewards",
+    "depth_rewards",
+    "difficulty_rewards",
+    "user_feedback_rewards",
+    "personality_feedback",
+)
+PROGRESS_STATE_KEYS = ("concept_progress", "subtopic_progress", "learning_point_progress")
+
+def flatten_progress(state: Dict) -> Dict[Tuple, object]:
+    """Map nested progress and bandit dicts to {row key: row value} for diffing and UPSERTs."""
+    rows: Dict[Tuple, object] = {}
+    for kind, state_key in (("concept", "concept_progress"), ("subtopic", "subtopic_progress")):
+        for key, entry in (state.get(state_key) or {}).items():
+            if isinstance(entry, dict):
+                rows[(kind, key)] = (bool(entry.get("unlocked")), bool(entry.get("mastered")))
+    for subtopic_key, points in (state.get("learning_point_progress") or {}).items():
+        if isinstance(points, dict):
+            for lp_key, status in points.items():
+                rows[("lp", subtopic_key, lp_key)] = status
+    bandit_stats = state.get("bandit_stats") or {}
+    for family in BANDIT_FAMILIES:
+        for arm, rewards in (bandit_stats.get(family) or {}).items():
+            rows[("bandit", family, arm)] = tuple(rewards)
+    return rows
+
+def _write_progress(c: sqlite3.Cursor, user_id: int, changes: Dict[Tuple, object], now: int):
+    concept_rows, subtopic_rows, lp_rows, bandit_rows = [], [], [], []
+    for key, value in changes.items():
+        kind = key[0]
+        if kind == "concept":
+            concept_rows.append((user_id, key[1], int(value[0]), int(value[1]), now))
+        elif kind == "subtopic":
+            subtopic_rows.append((user_id, key[1], int(value[0]), int(value[1]), now))
+        elif kind == "lp":
+            lp_rows.append((user_id, key[1], key[2], value, now))
+        elif kind == "bandit":
+            bandit_rows.append((user_id, key[1], key[2], json.dumps(list(value)), now))
+    if concept_rows:
+        c.executemany("""
+            INSERT INTO concept_progress (user_id, concept_key, unlocked, mastered, updated_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, concept_key) DO UPDATE SET
+                unlocked = excluded.unlocked, mastered = excluded.mastered, updated_at = excluded.updated_at
+        """, concept_rows)
+    if subtopic_rows:
+        c.executemany("""
+            INSERT INTO subtopic_progress (user_id, subtopic_key, unlocked, mastered, updated_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, subtopic_key) DO UPDATE SET
+                unlocked = excluded.unlocked, mastered = excluded.mastered, updated_at = excluded.updated_at
+        """, subtopic_rows)
+    if lp_rows:
+        c.executemany("""
+            INSERT INTO learning_point_progress (user_id, subtopic_key, lp_key, status, updated_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, subtopic_key, lp_key) DO UPDATE SET
+                status = excluded.status, updated_at = excluded.updated_at
+        """, lp_rows)
+    if bandit_rows:
+        c.executemany("""
+            INSERT INTO bandit_arms (user_id, family, arm, rewards, updated_at) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, family, arm) DO UPDATE SET
+                rewards = excluded.rewards, updated_at = excluded.updated_at
+        """, bandit_rows)
+
+def state_blob(state: Dict) -> Dict:
+    """The part of a full state snapshot that still lives in users.state_json."""
+    blob = {k: v for k, v in state.items() if k != "messages" and k not in PROGRESS_STATE_KEYS}
+    if isinstance(blob.get("bandit_stats"), dict):
+        blob["bandit_stats"] = {k: v for k, v in blob["bandit_stats"].items() if k not in BANDIT_FAMILIES}
+    return blob
+
+def save_progress(user_id: int, changes: Dict[Tuple, object]) -> bool:
+    """UPSERT only the progress rows in changes (as produced by flatten_progress)."""
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        _write_progress(c, user_id, changes, int(time.time()))
+        conn.commit()
+        return True
+    except Exception:
+        conn.rollback()
+        return False
+    finally:
+        _release_conn(conn)
+
+def get_progress(user_id: int) -> Dict:
+    """Rebuild concept/subtopic/learning-point progress and bandit arms for one user."""
+    conn = _get_conn()
+    c = conn.cursor()
+    progress = {
+        "concept_progress": {},
+        "subtopic_progress": {},
+        "learning_point_progress": {},
+        "bandit_stats": {},
+    }
+    try:
+        c.execute("SELECT concept_key, unlocked, mastered FROM concept_progress WHERE user_id = ?", (user_id,))
+        for key, unlocked, mastered in c.fetchall():
+            progress["concept_progress"][key] = {"unlocked": bool(unlocked), "mastered": bool(mastered)}
+        c.execute("SELECT subtopic_key, unlocked, mastered FROM subtopic_progress WHERE user_id = ?", (user_id,))
+        for key, unlocked, mastered in c.fetchall():
+            progress["subtopic_progress"][key] = {"unlocked": bool(unlocked), "mastered": bool(mastered)}
+        c.execute("SELECT subtopic_key, lp_key, status FROM learning_point_progress WHERE user_id = ?", (user_id,))
+        for subtopic_key, lp_key, status in c.fetchall():
+            progress["learning_point_progress"].setdefault(subtopic_key, {})[lp_key] = status
+        c.execute("SELECT family, arm, rewards FROM bandit_arms WHERE user_id = ?", (user_id,))
+        for family, arm, rewards in c.fetchall():
+            progress["bandit_stats"].setdefault(family, {})[arm] = json.loads(rewards)
+        return progress
+    except Exception:
+        return progress
+    finally:
+        _release_conn(conn)
+
+def count_learners_mastered(subtopic_key: str) -> int:
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        c.execute("SELECT COUNT(*) FROM subtopic_progress WHERE subtopic_key = ? AND mastered = 1", (subtopic_key,))
+        return c.fetchone()[0]
+    except Exception:
+        return 0
+    finally:
+        _release_conn(conn)
+
+def count_learning_point_status(subtopic_key: str, lp_key: str, status: str = "completed") -> int:
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        c.execute("SELECT COUNT(*) FROM learning_point_progress WHERE subtopic_key = ? AND lp_key = ? AND status = ?",
+                  (subtopic_key, lp_key, status))
+        return c.fetchone()[0]
+    except Exception:
+        return 0
+    finally:
+        _release_conn(conn)
+
+def _write_xp(c: sqlite3.Cursor, user_id: int, xp: int, level: int, awards: List[int], now: int):
+    c.execute("UPDATE users SET xp = ?, level = ?, last_seen = ? WHERE id = ?", (xp, level, now, user_id))
+    if awards:
+        c.executemany("INSERT INTO xp_events (user_id, amount, created_at) VALUES (?, ?, ?)",
+                      [(user_id, amount, now) for amount in awards])
+
+def save_xp(user_id: int, xp: int, level: int, awards: Optional[List[int]] = None) -> bool:
+    """Update the materialized xp/level columns and log any new awards for weekly deltas."""
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        _write_xp(c, user_id, xp, level, awards or [], int(time.time()))
+        conn.commit()
+        return True
+    except Exception:
+        conn.rollback()
+        return False
+    finally:
+        _release_conn(conn)
+
+WEEK_SECONDS = 7 * 24 * 3600
+# XP events only feed weekly gains, so anything older than the window can go.
+XP_EVENT_RETENTION_SECONDS = WEEK_SECONDS
+
+def purge_xp_events(max_age: int = XP_EVENT_RETENTION_SECONDS) -> int:
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        c.execute("DELETE FROM xp_events WHERE created_at < ?", (int(time.time()) - max_age,))
+        conn.commit()
+        return c.rowcount
+    except Exception:
+        return 0
+    finally:
+        _release_conn(conn)
+
+def get_leaderboard(limit: int = 10) -> List[Dict]:
+    """Top users by XP, each with the same tie-aware rank get_user_rank reports."""
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        c.execute("""
+            SELECT u.id, u.username, u.xp, u.level,
+                   (SELECT 1 + COUNT(*) FROM users WHERE xp > u.xp)
+            FROM users u ORDER BY u.xp DESC, u.id LIMIT ?
+        """, (limit,))
+        return [
+            {"user_id": user_id, "username": username, "xp": xp, "level": level, "rank": rank}
+            for user_id, username, xp, level, rank in c.fetchall()
+        ]
+    except Exception:
+        return []
+    finally:
+        _release_conn(conn)
+
+def get_user_rank(user_id: int) -> Optional[int]:
+    """1-based rank by XP; ties share the better rank."""
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        c.execute("""
+            SELECT (SELECT 1 + COUNT(*) FROM users WHERE xp > me.xp)
+            FROM users me WHERE me.id = ?
+        """, (user_id,))
+        row = c.fetchone()
+        return row[0] if row else None
+    except Exception:
+        return None
+    finally:
+        _release_conn(conn)
+
+def get_weekly_leaderboard(limit: int = 10, since: Optional[int] = None) -> List[Dict]:
+    """Top XP gainers since `since` (default: the last 7 days); equal gains share the better rank."""
+    if since is None:
+        since = int(time.time()) - WEEK_SECONDS
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        # Aggregate first, from the created_at index, so only the window's events are read;
+        # left to itself the planner walks every event through idx_xp_events_user to avoid a GROUP BY sort.
+        c.execute("""
+            SELECT w.user_id, u.username, w.gained, RANK() OVER (ORDER BY w.gained DESC)
+            FROM (
+                SELECT user_id, SUM(amount) AS gained
+                FROM xp_events INDEXED BY idx_xp_events_created
+                WHERE created_at >= ?
+                GROUP BY user_id
+            ) w JOIN users u ON u.id = w.user_id
+            ORDER BY w.gained DESC, w.user_id
+            LIMIT ?
+        """, (since, limit))
+        return [
+            {"user_id": user_id, "username": username, "xp_gained": gained, "rank": rank}
+            for user_id, username, gained, rank in c.fetchall()
+        ]
+    except Exception:
+        return []
+    finally:
+        _release_conn(conn)
+
+def get_weekly_xp(user_id: int, since: Optional[int] = None) -> int:
+    if since is None:
+        since = int(time.time()) - WEEK_SECONDS
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        c.execute("SELECT COALESCE(SUM(amount), 0) FROM xp_events WHERE user_id = ? AND created_at >= ?",
+                  (user_id, since))
+        return c.fetchone()[0]
+    except Exception:
+        return 0
+    finally:
+        _release_conn(conn)
 
 def save_user_state(user_id: int, state: Dict) -> bool:
     conn = _get_conn()
     c = conn.cursor()
     try:
-        payload = json.dumps(state)
-        c.execute("UPDATE users SET state_json = ?, last_seen = ? WHERE id = ?", (payload, int(time.time()), user_id))
+        size, version = _write_state(c, user_id, state, int(time.time()))
+        conn.commit()
+        _state_cache.put(user_id, state, size, version)
+        return True
+    except Exception:
+        return False
+    finally:
+        _release_conn(conn)
+
+def save_messages(user_id: int, start_seq: int, messages: List[Dict]) -> bool:
+    """Append messages from start_seq onwards, dropping any stale rows at or after it."""
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        _write_messages(c, user_id, start_seq, messages, int(time.time()))
+        conn.commit()
+        return True
+    except Exception:
+        conn.rollback()
+        return False
+    finally:
+        _release_conn(conn)
+
+def save_batch(entries: List[Dict]) -> Optional[Dict[int, int]]:
+    """Write state snapshots and message-log changes for several users in one transaction.
+
+    Each entry has a user_id plus an optional "state" dict, an optional
+    "messages" (start_seq, messages) pair, optional "progress" row
+    changes and an optional "xp" (xp, level) pair with "xp_awards", as
+    passed to save_user_state(), save_messages(), save_progress() and
+    save_xp(). Returns {user_id: new state_version} for the states
+    written, or None if the transaction failed.
+    """
+    conn = _get_conn()
+    c = conn.cursor()
+    written_states = []
+    try:
+        now = int(time.time())
+        for entry in entries:
+            if entry.get("progress"):
+                _write_progress(c, entry["user_id"], entry["progress"], now)
+            if entry.get("xp") is not None:
+                xp, level = entry["xp"]
+                _write_xp(c, entry["user_id"], xp, level, entry.get("xp_awards") or [], now)
+            if entry.get("messages") is not None:
+                start_seq, messages = entry["messages"]
+                _write_messages(c, entry["user_id"], start_seq, messages, now)
+            if entry.get("state") is not None:
+                size, version = _write_state(c, entry["user_id"], entry["state"], now)
+                written_states.append((entry["user_id"], entry["state"], size, version))
+        conn.commit()
+        for user_id, state, size, version in written_states:
+            _state_cache.put(user_id, state, size, version)
+        return {user_id: version for user_id, _, _, version in written_states}
+    except Exception:
+        conn.rollback()
+        return None
+    finally:
+        _release_conn(conn)
+
+def get_messages(user_id: int, limit: Optional[int] = None, before_seq: Optional[int] = None) -> List[Dict]:
+    """Return messages in order, optionally only the `limit` most recent ones before `before_seq`."""
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        query = "SELECT seq, role, content, metadata FROM messages WHERE user_id = ?"
+        params: List = [user_id]
+        if before_seq is not None:
+            query += " AND seq < ?"
+            params.append(before_seq)
+        query += " ORDER BY seq DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        c.execute(query, params)
+        rows = c.fetchall()
+        rows.reverse()
+        return [
+            {"seq": seq, "role": role, "content": decode_payload(content),
+             "metadata": json.loads(metadata) if metadata else None}
+            for seq, role, content, metadata in rows
+        ]
+    except Exception:
+        return []
+    finally:
+        _release_conn(conn)
+
+def get_cached_responses(cache_key: str, max_age: int) -> List[Tuple[str, int]]:
+    """Return (content, created_at) for each stored reply variant younger than max_age seconds."""
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        c.execute(
+            "SELECT content, created_at FROM response_cache WHERE cache_key = ? AND created_at > ? ORDER BY variant",
+            (cache_key, int(time.time()) - max_age),
+        )
+        return [(decode_payload(content), created_at) for content, created_at in c.fetchall()]
+    except Exception:
+        return []
+    finally:
+        _release_conn(conn)
+
+def save_cached_response(cache_key: str, variant: int, content: str, created_at: Optional[int] = None) -> bool:
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        c.execute(
+            "INSERT OR REPLACE INTO response_cache (cache_key, variant, content, created_at) VALUES (?, ?, ?, ?)",
+            (cache_key, variant, encode_payload(content), created_at or int(time.time())),
+        )
+        conn.commit()
+        return True
+    except Exception:
+        return False
+    finally:
+        _release_conn(conn)
+
+def purge_response_cache(max_age: int) -> int:
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        c.execute("DELETE FROM response_cache WHERE created_at <= ?", (int(time.time()) - max_age,))
+        conn.commit()
+        return c.rowcount
+    except Exception:
+        return 0
+    finally:
+        _release_conn(conn)
+
+def get_pdf_upload(sha256: str) -> Optional[Dict]:
+    """Return the remote file recorded for a PDF's content hash, if it hasn't expired."""
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        c.execute(
+            "SELECT file_name, expires_at FROM pdf_uploads WHERE sha256 = ? AND expires_at > ?",
+            (sha256, int(time.time())),
+        )
+        row = c.fetchone()
+        return {"file_name": row[0], "expires_at": row[1]} if row else None
+    except Exception:
+        return None
+    finally:
+        _release_conn(conn)
+
+def save_pdf_upload(sha256: str, file_name: str, expires_at: int) -> bool:
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        c.execute(
+            """
+            INSERT INTO pdf_uploads (sha256, file_name, expires_at, created_at) VALUES (?, ?, ?, ?)
+            ON CONFLICT(sha256) DO UPDATE SET file_name = excluded.file_name,
+                expires_at = excluded.expires_at, created_at = excluded.created_at
+            """,
+            (sha256, file_name, int(expires_at), int(time.time())),
+        )
         conn.commit()
         return True
     except Exception:
         return False
     finally:
-        conn.close()
+        _release_conn(conn)
+
+USAGE_COLUMNS = (
+    "created_at", "user_id", "personality", "flow", "kind", "source", "model", "ok", "wall_ms", "ttft_ms",
+    "prompt_tokens", "response_tokens", "system_tokens_est", "history_tokens_est", "attachment_tokens_est",
+)
+USAGE_DIMENSIONS = ("user_id", "personality", "flow", "kind", "source")
+
+def save_llm_usage(rows: List[Dict]) -> bool:
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        c.executemany(
+            f"INSERT INTO llm_usage ({', '.join(USAGE_COLUMNS)}) VALUES ({', '.join('?' for _ in USAGE_COLUMNS)})",
+            [tuple(row.get(col) for col in USAGE_COLUMNS) for row in rows],
+        )
+        conn.commit()
+        return True
+    except Exception:
+        return False
+    finally:
+        _release_conn(conn)
+
+def get_usage_rollup(dimension: str, since: Optional[int] = None) -> List[Dict]:
+    """Call counts, latency and tokens grouped by user_id, personality, flow, kind or source, costliest first."""
+    if dimension not in USAGE_DIMENSIONS:
+        raise ValueError(f"Unknown usage dimension: {dimension}")
+    conn = _get_conn()
+    c = conn.cursor()
+    try:
+        c.execute(
+            f"""
+            SELECT {dimension}, COUNT(*), SUM(source = 'api'), SUM(ok = 0), AVG(wall_ms), AVG(ttft_ms),
+                   SUM(prompt_tokens), SUM(response_tokens)
+            FROM llm_usage
+            WHERE created_at >= ?
+            GROUP BY {dimension}
+            ORDER BY SUM(prompt_tokens) + SUM(response_tokens) DESC
+            """,
+            (since or 0,),
+        )
+        return [
+            {"key": key, "calls": calls, "api_calls": api_calls or 0, "failures": failures or 0,
+             "avg_wall_ms": avg_wall or 0.0, "avg_ttft_ms": avg_ttft, "prompt_tokens": prompt or 0,
+             "response_tokens": response or 0, "total_tokens": (prompt or 0) + (response or 0)}
+            for key, calls, api_calls, failures, avg_wall, avg_ttft, prompt, response in c.fetchall()
+        ]
+    except Exception:
+        return []
+    finally:
+        _release_conn(conn)
@@ -0,0 +1,455 @@
+import hashlib
+import os
+import random
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional, Tuple
+
+import db
+
+genai_import_error: Optional[str] = None
+try:
+    import google.generativeai as genai
+except Exception as e:
+    genai_import_error = str(e)
+    genai = None
+
+# Named model tiers; each can be pointed at a different model with TUTORQUEST_MODEL_<TIER>.
+MODEL_TIERS = {
+    "default": os.getenv("TUTORQUEST_MODEL_DEFAULT", "gemini-2.5-flash"),
+    "lite": os.getenv("TUTORQUEST_MODEL_LITE", "gemini-2.5-flash-lite"),
+    "pro": os.getenv("TUTORQUEST_MODEL_PRO", "gemini-2.5-pro"),
+}
+# A tier counts as unhealthy after this many failures in a row, until its next success.
+UNHEALTHY_AFTER_FAILURES = 3
+# Gemini keeps uploaded files for 48 hours; stop reusing a handle an hour before that.
+FILE_TTL_SECONDS = 48 * 3600
+FILE_EXPIRY_MARGIN_SECONDS = 3600
+# Per-request timeout, and the overall deadline for a call including its retries.
+REQUEST_TIMEOUT_SECONDS = float(os.getenv("TUTORQUEST_GEMINI_TIMEOUT", "30"))
+CALL_DEADLINE_SECONDS = float(os.getenv("TUTORQUEST_GEMINI_DEADLINE", "45"))
+MAX_ATTEMPTS = 3
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_CAP_SECONDS = 8.0
+# Open the breaker after this many calls in a row fail with retryable errors; probe again after the cooldown.
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_COOLDOWN_SECONDS = 30.0
+RETRYABLE_STATUS_CODES = frozenset({408, 429, 500, 502, 503, 504})
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling Gemini while the circuit breaker is open."""
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Timeouts, dropped connections, rate limits and 5xx responses are worth another try."""
+    if isinstance(exc, (TimeoutError, ConnectionError)):
+        return True
+    code = getattr(exc, "code", None)
+    try:
+        return int(code) in RETRYABLE_STATUS_CODES
+    except (TypeError, ValueError):
+        return type(exc).__name__ in {"DeadlineExceeded", "ServiceUnavailable", "TooManyRequests", "ResourceExhausted"}
+
+
+def backoff_delay(attempt: int, base: float = BACKOFF_BASE_SECONDS, cap: float = BACKOFF_CAP_SECONDS) -> float:
+    """Full-jitter exponential backoff before retry number `attempt` (0-based)."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """Closed -> open after repeated failures -> half-open probe after a cooldown.
+
+    While open, allow() is False and callers should fail fast. Once the
+    cooldown has passed a single caller is let through as a probe; its
+    success closes the breaker and its failure re-opens it.
+    """
+
+    def __init__(self, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 cooldown_seconds: float = BREAKER_COOLDOWN_SECONDS):
+        self.failure_threshold = failure_threshold
+        self.cooldown_seconds = cooldown_seconds
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._probing = False
+        self._lock = threading.Lock()
+        self._counters = {"opened": 0, "rejected": 0}
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if self._probing or time.monotonic() - self._opened_at >= self.cooldown_seconds:
+                return "half_open"
+            return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if not self._probing and time.monotonic() - self._opened_at >= self.cooldown_seconds:
+                self._probing = True
+                return True
+            self._counters["rejected"] += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probing = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._probing or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._probing:
+                    self._counters["opened"] += 1
+                self._opened_at = time.monotonic()
+                self._probing = False
+
+    def release(self):
+        """A caller stopped without an outcome; let the next caller probe instead."""
+        with self._lock:
+            self._probing = False
+
+    def stats(self) -> Dict:
+        state = self.state
+        with self._lock:
+            counters = dict(self._counters)
+            counters["consecutive_failures"] = self._failures
+        counters["state"] = state
+        return counters
+
+
+def call_with_retry(fn: Callable[[float], object], breaker: Optional[CircuitBreaker] = None,
+                    attempts: int = MAX_ATTEMPTS, timeout: float = REQUEST_TIMEOUT_SECONDS,
+                    deadline: float = CALL_DEADLINE_SECONDS, sleep: Callable[[float], None] = time.sleep,
+                    on_retry: Optional[Callable[[BaseException], None]] = None):
+    """Call fn(timeout) until it succeeds, retrying retryable errors with jittered backoff.
+
+    Each attempt gets at most `timeout` seconds and never runs past the
+    overall `deadline`. Raises CircuitOpenError without calling fn while
+    the breaker is open; other errors propagate once retries run out.
+    """
+    if breaker is not None and not breaker.allow():
+        raise CircuitOpenError("Gemini calls are paused after repeated failures")
+    give_up_at = time.monotonic() + deadline
+    attempt = 0
+    settled = False
+    try:
+        while True:
+            remaining = give_up_at - time.monotonic()
+            try:
+                # The floor only keeps a nearly spent deadline from passing a zero timeout; it never exceeds `timeout`.
+                result = fn(min(timeout, max(0.1, remaining)))
+            except Exception as e:
+                retryable = is_retryable(e)
+                delay = backoff_delay(attempt)
+                attempt += 1
+                if not retryable or attempt >= attempts or time.monotonic() + delay >= give_up_at:
+                    settled = True
+                    if breaker is not None:
+                        if retryable:
+                            breaker.record_failure()
+                        else:
+                            # The service answered; the request itself was bad.
+                            breaker.record_success()
+                    raise
+                if on_retry is not None:
+                    on_retry(e)
+                sleep(delay)
+                continue
+            settled = True
+            if breaker is not None:
+                breaker.record_success()
+            return result
+    finally:
+        if breaker is not None and not settled:
+            # Interrupted (KeyboardInterrupt, a script rerun) before any outcome; a half-open
+            # breaker would otherwise wait forever for this probe to report back.
+            breaker.release()
+
+
+def file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _file_expiry(handle) -> float:
+    expiration = getattr(handle, "expiration_time", None)
+    try:
+        expires_at = expiration.timestamp()
+    except Exception:
+        expires_at = time.time() + FILE_TTL_SECONDS
+    return expires_at - FILE_EXPIRY_MARGIN_SECONDS
+
+
+class PdfUploadRegistry:
+    """Remote file handles keyed by the SHA-256 of the uploaded bytes.
+
+    Handles are kept in memory for this process and recorded in the
+    pdf_uploads table so other processes can fetch them by name instead
+    of uploading again. Concurrent requests for the same content wait on
+    the single upload already in flight.
+    """
+
+    def __init__(self, upload: Callable[[str], object], fetch: Callable[[str], object]):
+        self._upload = upload
+        self._fetch = fetch
+        self._handles: Dict[str, Tuple[object, float]] = {}
+        self._in_flight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._counters = {"memory_hits": 0, "db_hits": 0, "uploads": 0, "coalesced": 0}
+
+    def get_or_upload(self, path: str) -> Tuple[object, str]:
+        """Return (handle, source); source is "memory", "db", "coalesced" or "upload"."""
+        digest = file_sha256(path)
+        with self._lock:
+            cached = self._handles.get(digest)
+            if cached is not None and cached[1] > time.time():
+                self._counters["memory_hits"] += 1
+                return cached[0], "memory"
+            future = self._in_flight.get(digest)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._in_flight[digest] = future
+            else:
+                self._counters["coalesced"] += 1
+        if not owner:
+            return future.result(), "coalesced"
+        try:
+            handle, expires_at, source = self._resolve(digest, path)
+        except BaseException as e:
+            with self._lock:
+                self._in_flight.pop(digest, None)
+            future.set_exception(e)
+            raise
+        with self._lock:
+            self._handles[digest] = (handle, expires_at)
+            self._in_flight.pop(digest, None)
+        future.set_result(handle)
+        return handle, source
+
+    def stats(self) -> Dict:
+        with self._lock:
+            counters = dict(self._counters)
+            counters["files"] = len(self._handles)
+        return counters
+
+    def _resolve(self, digest: str, path: str) -> Tuple[object, float, str]:
+        row = db.get_pdf_upload(digest)
+        if row is not None:
+            try:
+                handle = self._fetch(row["file_name"])
+                with self._lock:
+                    self._counters["db_hits"] += 1
+                return handle, row["expires_at"], "db"
+            except Exception:
+                pass  # Deleted or expired early on the server; upload again.
+        handle = self._upload(path)
+        expires_at = _file_expiry(handle)
+        db.save_pdf_upload(digest, handle.name, expires_at)
+        with self._lock:
+            self._counters["uploads"] += 1
+        return handle, expires_at, "upload"
+
+
+class GeminiClientManager:
+    """Process-wide Gemini configuration, model handles and call health.
+
+    genai.configure() runs once when the manager is created and each
+    tier's GenerativeModel is built on first use, then shared by every
+    session. Calls wrapped in track() feed per-tier latency and failure
+    counters.
+    """
+
+    def __init__(self, api_key: str, tiers: Optional[Dict[str, str]] = None):
+        self.api_key = api_key
+        self.tiers = dict(tiers or MODEL_TIERS)
+        self._models: Dict[str, object] = {}
+        self._health: Dict[str, Dict] = {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+        genai.configure(api_key=api_key)
+        self.pdf_uploads = PdfUploadRegistry(self._upload_file, genai.get_file)
+
+    def model(self, tier: str = "default"):
+        """Return the shared GenerativeModel for a tier."""
+        with self._lock:
+            handle = self._models.get(tier)
+            if handle is None:
+                handle = genai.GenerativeModel(self.tiers[tier])
+                self._models[tier] = handle
+        return handle
+
+    def breaker(self, tier: str = "default") -> CircuitBreaker:
+        with self._lock:
+            breaker = self._breakers.get(tier)
+            if breaker is None:
+                breaker = self._breakers[tier] = CircuitBreaker()
+        return breaker
+
+    def call(self, fn: Callable[[float], object], tier: str = "default"):
+        """Run fn(timeout) with deadlines, retries and the tier's circuit breaker, tracking every attempt."""
+        def attempt(timeout: float):
+            with self.track(tier):
+                return fn(timeout)
+
+        return call_with_retry(attempt, self.breaker(tier), on_retry=lambda e: self._count_retry(tier))
+
+    def upload_file(self, path: str) -> Tuple[object, str]:
+        """Return (remote handle, source) for the file, uploading only if this content isn't already there."""
+        return self.pdf_uploads.get_or_upload(path)
+
+    def _upload_file(self, path: str):
+        # upload_file() takes no per-request timeout; it still gets retries and the breaker.
+        return self.call(lambda timeout: genai.upload_file(path), "upload")
+
+    @contextmanager
+    def track(self, tier: str = "default"):
+        """Time the enclosed call and record its outcome against `tier`."""
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self._record(tier, time.perf_counter() - start, ok=False)
+            raise
+        self._record(tier, time.perf_counter() - start, ok=True)
+
+    def healthy(self, tier: str = "default") -> bool:
+        if self.breaker(tier).state == "open":
+            return False
+        with self._lock:
+            health = self._health.get(tier)
+            return health is None or health["consecutive_failures"] < UNHEALTHY_AFTER_FAILURES
+
+    def stats(self) -> Dict[str, Dict]:
+        with self._lock:
+            snapshot = {tier: dict(health) for tier, health in self._health.items()}
+            breakers = dict(self._breakers)
+        for tier, health in snapshot.items():
+            health["avg_ms"] = health["total_ms"] / health["calls"] if health["calls"] else 0.0
+            health["healthy"] = health["consecutive_failures"] < UNHEALTHY_AFTER_FAILURES
+            if tier in breakers:
+                health["breaker"] = breakers[tier].stats()
+                health["healthy"] = health["healthy"] and health["breaker"]["state"] != "open"
+        return snapshot
+
+    def _count_retry(self, tier: str):
+        with self._lock:
+            if tier in self._health:
+                self._health[tier]["retries"] += 1
+
+    def _record(self, tier: str, elapsed: float, ok: bool):
+        elapsed_ms = elapsed * 1000
+        with self._lock:
+            health = self._health.setdefault(tier, {
+                "calls": 0, "failures": 0, "consecutive_failures": 0, "retries": 0,
+                "last_ms": 0.0, "max_ms": 0.0, "total_ms": 0.0, "last_error_at": None,
+            })
+            health["calls"] += 1
+            health["last_ms"] = elapsed_ms
+            health["max_ms"] = max(health["max_ms"], elapsed_ms)
+            health["total_ms"] += elapsed_ms
+            if ok:
+                health["consecutive_failures"] = 0
+            else:
+                health["failures"] += 1
+                health["consecutive_failures"] += 1
+                health["last_error_at"] = time.time()
+
+
+class _LeaderAbandoned(Exception):
+    """The leader stopped without a result of its own (e.g. its script was rerun)."""
+
+
+class SingleFlight:
+    """Collapses concurrent calls with the same key into one.
+
+    The first caller for a key (the leader) runs the function; callers
+    that arrive while it is in flight wait for and share its result, or
+    its exception. Only ordinary exceptions are shared: if the leader is
+    interrupted by a BaseException (Streamlit's rerun and stop signals
+    are ones), the waiting callers elect a new leader among themselves.
+    Nothing is kept once the call finishes.
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._counters = {"calls": 0, "merged": 0, "abandoned": 0}
+
+    def do(self, key: str, fn: Callable[[], object], timeout: Optional[float] = None) -> Tuple[object, bool]:
+        """Return (result, shared); shared is True if another caller's result was reused."""
+        while True:
+            with self._lock:
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = Future()
+                    self._counters["calls"] += 1
+                else:
+                    self._counters["merged"] += 1
+            if leader:
+                break
+            try:
+                return flight.result(timeout=timeout), True
+            except _LeaderAbandoned:
+                continue
+        try:
+            result = fn()
+        except Exception as e:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.set_exception(e)
+            raise
+        except BaseException:
+            with self._lock:
+                self._flights.pop(key, None)
+                self._counters["abandoned"] += 1
+            flight.set_exception(_LeaderAbandoned())
+            raise
+        with self._lock:
+            self._flights.pop(key, None)
+        flight.set_result(result)
+        return result, False
+
+    def stats(self) -> Dict:
+        with self._lock:
+            counters = dict(self._counters)
+            counters["in_flight"] = len(self._flights)
+        return counters
+
+
+_single_flight = SingleFlight()
+
+
+def get_single_flight() -> SingleFlight:
+    return _single_flight
+
+
+_client_manager: Optional[GeminiClientManager] = None
+_client_manager_lock = threading.Lock()
+
+
+def get_client_manager(api_key: Optional[str]) -> Optional[GeminiClientManager]:
+    """Return the process-wide manager, or None without an API key or the genai package.
+
+    The manager is rebuilt only if the API key changes.
+    """
+    global _client_manager
+    if not api_key or genai is None:
+        return None
+    if _client_manager is None or _client_manager.api_key != api_key:
+        with _client_manager_lock:
+            if _client_manager is None or _client_manager.api_key != api_key:
+                _client_manager = GeminiClientManager(api_key)
+    return _client_manager
@@ -0,0 +1,115 @@
+import math
+import re
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+try:
+    from pypdf import PdfReader
+except Exception:
+    PdfReader = None
+
+CHUNK_WORDS = 160
+CHUNK_OVERLAP_WORDS = 40
+TOP_K = 4
+
+_TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+_STOPWORDS = frozenset(
+    "a an and are as at be by did do for from had has have how in is it its of on or that the their them "
+    "they this to was were what when where which who why will with you your".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in _TOKEN_PATTERN.findall(text.lower()) if t not in _STOPWORDS]
+
+
+@dataclass
+class Chunk:
+    page: int
+    text: str
+
+
+def extract_pages(path: str) -> List[str]:
+    """Text of each page, or [] if pypdf isn't installed or the PDF has no text layer."""
+    if PdfReader is None:
+        return []
+    try:
+        reader = PdfReader(path)
+        return [page.extract_text() or "" for page in reader.pages]
+    except Exception:
+        return []
+
+
+def chunk_pages(pages: List[str], size: int = CHUNK_WORDS, overlap: int = CHUNK_OVERLAP_WORDS) -> List[Chunk]:
+    """Split page text into overlapping word windows that remember their page number."""
+    chunks = []
+    step = max(1, size - overlap)
+    for page_no, text in enumerate(pages, 1):
+        words = text.split()
+        for start in range(0, len(words), step):
+            window = words[start:start + size]
+            if window:
+                chunks.append(Chunk(page=page_no, text=" ".join(window)))
+            if start + size >= len(words):
+                break
+    return chunks
+
+
+class BM25Index:
+    """Okapi BM25 over a fixed list of chunks, built once and queried per turn."""
+
+    def __init__(self, chunks: List[Chunk], k1: float = 1.5, b: float = 0.75):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        self._postings: Dict[str, List[Tuple[int, int]]] = {}
+        self._lengths = []
+        for idx, chunk in enumerate(chunks):
+            counts = Counter(tokenize(chunk.text))
+            self._lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                self._postings.setdefault(term, []).append((idx, tf))
+        self._avg_length = sum(self._lengths) / len(self._lengths) if self._lengths else 0.0
+        n = len(chunks)
+        self._idf = {
+            term: math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+            for term, postings in self._postings.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def search(self, query: str, k: int = TOP_K) -> List[Tuple[float, Chunk]]:
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            idf = self._idf.get(term)
+            if idf is None:
+                continue
+            for idx, tf in self._postings[term]:
+                norm = self.k1 * (1 - self.b + self.b * self._lengths[idx] / self._avg_length)
+                scores[idx] = scores.get(idx, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        best = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:k]
+        # Keep the passages in document order so they read naturally.
+        return [(score, self.chunks[idx]) for idx, score in sorted(best)]
+
+
+def format_passages(results: List[Tuple[float, Chunk]]) -> str:
+    return "\n\n".join(f"[p. {chunk.page}] {chunk.text}" for _, chunk in results)
+
+
+_indexes: Dict[str, Optional[BM25Index]] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_pdf_index(path: str, key: str) -> Optional[BM25Index]:
+    """Build (once per process per content key) the index for a PDF; None if it has no usable text."""
+    with _indexes_lock:
+        if key in _indexes:
+            return _indexes[key]
+    chunks = chunk_pages(extract_pages(path))
+    index = BM25Index(chunks) if chunks else None
+    with _indexes_lock:
+        _indexes.setdefault(key, index)
+        return _indexes[key]
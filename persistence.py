@@ -0,0 +1,355 @@
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+import db
+
+STATE_DIR = Path(__file__).with_name("state_store")
+
+
+class StateShardStore:
+    """Local copy of each user's users.state_json, one JSON file per user.
+
+    Files are written to a temp file and renamed into place, so a reader
+    never sees a half-written shard. Nothing is kept in memory: shards are
+    only read at login, and decoded state is already cached by db's
+    byte-bounded LRU.
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+
+    def path_for(self, user_id: int) -> Path:
+        return self.root / f"user_{int(user_id)}.json"
+
+    def load(self, user_id: int) -> Dict:
+        try:
+            with self.path_for(user_id).open("r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return data if isinstance(data, dict) else {}
+
+    def save(self, user_id: int, data: Dict):
+        self.root.mkdir(parents=True, exist_ok=True)
+        path = self.path_for(user_id)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix=path.stem + ".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+
+
+_shard_store: Optional[StateShardStore] = None
+_shard_store_lock = threading.Lock()
+
+
+def get_shard_store() -> StateShardStore:
+    global _shard_store
+    if _shard_store is None:
+        with _shard_store_lock:
+            if _shard_store is None:
+                _shard_store = StateShardStore(STATE_DIR)
+    return _shard_store
+
+
+def load_user_state(user_id: int) -> Optional[Dict]:
+    """A user's stored state, read from the local shard when it's as new as the DB's copy."""
+    version = db.get_state_version(user_id)
+    shard = get_shard_store().load(user_id)
+    if version is not None and shard.get("version") == version and isinstance(shard.get("state"), dict):
+        return shard["state"]
+    return db.get_user_state(user_id)
+
+
+MessageOp = Tuple[int, List[Dict]]
+
+
+def _merge_message_ops(earlier: Optional[MessageOp], later: MessageOp) -> MessageOp:
+    """Fold two pending message-log writes into one; later rows win from their start onwards.
+
+    The app never syncs past its previous high-water mark, so the later
+    range always starts inside or right after the earlier one.
+    """
+    if earlier is None:
+        return later
+    start, rows = earlier
+    later_start, later_rows = later
+    if later_start <= start:
+        return later
+    return start, rows[:later_start - start] + later_rows
+
+
+def _new_entry() -> Dict:
+    return {"state": None, "messages": None, "progress": {}, "xp": None, "xp_awards": [], "attempts": 0}
+
+
+def _merge_entry(entry: Dict, later: Dict):
+    """Fold a later pending write for the same user into entry."""
+    if later["state"] is not None:
+        entry["state"] = later["state"]
+    if later["messages"] is not None:
+        entry["messages"] = _merge_message_ops(entry["messages"], later["messages"])
+    if later["progress"]:
+        entry["progress"].update(later["progress"])
+    if later["xp"] is not None:
+        entry["xp"] = later["xp"]
+    if later["xp_awards"]:
+        entry["xp_awards"].extend(later["xp_awards"])
+
+
+class WriteBehindWriter:
+    """Process-wide background writer for user state.
+
+    The script thread hands over snapshots with submit() and returns
+    immediately. Snapshots for the same user collapse while they wait,
+    and each drain writes one batched SQLite transaction, then refreshes
+    the shards of the users whose state it wrote. At most max_pending
+    users can be waiting; beyond that submit() blocks until the worker
+    catches up.
+
+    The app moves its sync markers forward as soon as it submits, so a
+    batch whose transaction fails is retried one user at a time, and
+    only the entries that fail on their own are put back in front of
+    anything submitted since and retried with exponential backoff. An
+    entry that has failed max_attempts times is dropped and reported in
+    stats() so one bad row cannot hold up everyone else's writes.
+    """
+
+    def __init__(self, shard_store: StateShardStore, max_pending: int = 256, batch_window: float = 0.05,
+                 retry_delay: float = 0.5, max_retry_delay: float = 30.0, max_attempts: int = 5):
+        self.shard_store = shard_store
+        self.max_pending = max_pending
+        self.batch_window = batch_window
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_attempts = max_attempts
+        self._pending: "OrderedDict[int, Dict]" = OrderedDict()
+        self._in_flight: Set[int] = set()
+        self._dropped_users: List[int] = []
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self._metrics = {
+            "submitted": 0,
+            "coalesced": 0,
+            "batches": 0,
+            "users_written": 0,
+            "failures": 0,
+            "retries": 0,
+            "dropped": 0,
+            "last_write_ms": 0.0,
+            "max_write_ms": 0.0,
+            "total_write_ms": 0.0,
+        }
+
+    def submit(
+        self,
+        user_id: int,
+        state: Optional[Dict] = None,
+        messages: Optional[MessageOp] = None,
+        progress: Optional[Dict] = None,
+        xp: Optional[Tuple[int, int]] = None,
+        xp_awards: Optional[List[int]] = None,
+    ):
+        """Queue a state snapshot, message-log change, progress row changes and/or XP update.
+
+        The caller must not mutate the arguments afterwards.
+        """
+        update = {
+            "state": state, "messages": messages, "progress": dict(progress or {}),
+            "xp": xp, "xp_awards": list(xp_awards or []),
+        }
+        with self._cond:
+            if self._closed:
+                self._write_batch({user_id: update})
+                return
+            while user_id not in self._pending and len(self._pending) >= self.max_pending:
+                self._cond.wait()
+            self._metrics["submitted"] += 1
+            entry = self._pending.get(user_id)
+            if entry is None:
+                entry = _new_entry()
+                self._pending[user_id] = entry
+            else:
+                self._metrics["coalesced"] += 1
+            _merge_entry(entry, update)
+            self._ensure_thread()
+            self._cond.notify_all()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Block until everything submitted so far is written. Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._in_flight:
+                self._ensure_thread()
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def flush_user(self, user_id: int, timeout: Optional[float] = None) -> bool:
+        """Block until everything submitted so far for one user is written. Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while user_id in self._pending or user_id in self._in_flight:
+                self._ensure_thread()
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def close(self, timeout: Optional[float] = 10.0):
+        """Drain the queue and stop the worker; later submits are written synchronously."""
+        self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stats(self) -> Dict:
+        with self._cond:
+            metrics = dict(self._metrics)
+            metrics["queue_depth"] = len(self._pending) + len(self._in_flight)
+            metrics["dropped_users"] = list(self._dropped_users)
+        batches = metrics["batches"]
+        metrics["avg_write_ms"] = metrics["total_write_ms"] / batches if batches else 0.0
+        return metrics
+
+    def _ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="tutorquest-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        delay = 0.0
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending and self._closed:
+                    return
+            # Give rapid-fire snapshots from the same rerun a moment to collapse,
+            # or back off after a failed transaction.
+            time.sleep(max(self.batch_window, delay))
+            with self._cond:
+                batch, self._pending = self._pending, OrderedDict()
+                self._in_flight = set(batch)
+                self._cond.notify_all()
+            failed = batch
+            try:
+                failed = self._write_batch(batch)
+            finally:
+                with self._cond:
+                    if failed:
+                        self._requeue(failed)
+                    self._in_flight = set()
+                    self._cond.notify_all()
+            delay = 0.0 if not failed else min(self.max_retry_delay, max(self.retry_delay, delay * 2))
+
+    def _requeue(self, failed: "OrderedDict[int, Dict]"):
+        """Put failed entries back, ahead of anything submitted while they were being written. Holds _cond.
+
+        Entries that have now failed max_attempts times are dropped instead.
+        """
+        self._metrics["retries"] += 1
+        retry = OrderedDict()
+        for user_id, entry in failed.items():
+            entry["attempts"] += 1
+            if entry["attempts"] >= self.max_attempts:
+                self._metrics["dropped"] += 1
+                self._dropped_users.append(user_id)
+                del self._dropped_users[:-20]
+            else:
+                retry[user_id] = entry
+        newer, self._pending = self._pending, retry
+        for user_id, later in newer.items():
+            entry = self._pending.get(user_id)
+            if entry is None:
+                self._pending[user_id] = later
+            else:
+                _merge_entry(entry, later)
+
+    def _write_batch(self, batch: "OrderedDict[int, Dict]") -> "OrderedDict[int, Dict]":
+        """Write one batch; returns the entries that could not be committed.
+
+        If the batched transaction fails, each user is written in a
+        transaction of their own so a single bad entry only fails itself.
+        """
+        failed = OrderedDict()
+        if not batch:
+            return failed
+        start = time.perf_counter()
+        failures = 0
+        db_entries = []
+        for user_id, entry in batch.items():
+            state = entry["state"]
+            db_entries.append({
+                "user_id": user_id,
+                "state": db.state_blob(state) if state is not None else None,
+                "messages": entry["messages"],
+                "progress": entry.get("progress"),
+                "xp": entry.get("xp"),
+                "xp_awards": entry.get("xp_awards"),
+            })
+        versions = db.save_batch(db_entries)
+        if versions is None:
+            failures += 1
+            versions = {}
+            if len(db_entries) > 1:
+                for db_entry in db_entries:
+                    single = db.save_batch([db_entry])
+                    if single is None:
+                        failures += 1
+                        failed[db_entry["user_id"]] = batch[db_entry["user_id"]]
+                    else:
+                        versions.update(single)
+            else:
+                failed = OrderedDict(batch)
+        # Shards only ever mirror committed state, tagged with the version they match.
+        for db_entry in db_entries:
+            version = versions.get(db_entry["user_id"])
+            if version is None:
+                continue
+            try:
+                self.shard_store.save(db_entry["user_id"], {"version": version, "state": db_entry["state"]})
+            except Exception:
+                failures += 1
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with self._cond:
+            self._metrics["batches"] += 1
+            self._metrics["users_written"] += len(batch) - len(failed)
+            self._metrics["failures"] += failures
+            self._metrics["last_write_ms"] = elapsed_ms
+            self._metrics["max_write_ms"] = max(self._metrics["max_write_ms"], elapsed_ms)
+            self._metrics["total_write_ms"] += elapsed_ms
+        return failed
+
+
+_writer: Optional[WriteBehindWriter] = None
+_writer_lock = threading.Lock()
+
+
+def get_writer() -> WriteBehindWriter:
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = WriteBehindWriter(get_shard_store())
+                atexit.register(_writer.close)
+    return _writer
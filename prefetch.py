@@ -0,0 +1,102 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Optional, Tuple
+
+PREFETCH_WORKERS = 4
+PREFETCH_WAIT_SECONDS = 60.0
+
+
+@dataclass
+class PrefetchEntry:
+    slot: str
+    key: str
+    future: Future
+    started_at: float = field(default_factory=time.monotonic)
+    meta: Dict = field(default_factory=dict)
+
+
+class Prefetcher:
+    """Speculative tutor replies generated on a small shared thread pool.
+
+    A session submits a generation it expects to need (e.g. the reply to
+    "continue") under a key describing the exact conversation state. When
+    the learner asks for it, claim() hands back the result if the key
+    still matches; otherwise the session discards it. Wasted tokens from
+    discarded generations are counted once they finish.
+    """
+
+    def __init__(self, max_workers: int = PREFETCH_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tutorquest-prefetch")
+        self._lock = threading.Lock()
+        self._counters: Dict[str, Dict] = {}
+
+    def submit(self, slot: str, key: str, fn: Callable[[], Tuple[str, int]], **meta) -> PrefetchEntry:
+        """Start fn() in the background. fn returns (reply text, tokens used)."""
+        self._count(slot, "started")
+        return PrefetchEntry(slot=slot, key=key, future=self._executor.submit(fn), meta=meta)
+
+    def claim(self, entry: PrefetchEntry, timeout: float = PREFETCH_WAIT_SECONDS) -> Optional[str]:
+        """Wait for and return a prefetched reply, or None if it failed."""
+        ready = entry.future.done()
+        start = time.monotonic()
+        try:
+            reply, _ = entry.future.result(timeout=timeout)
+        except Exception:  # Failed, cancelled or still running after `timeout`.
+            self._count(entry.slot, "failed")
+            return None
+        with self._lock:
+            counters = self._slot(entry.slot)
+            counters["hits"] += 1
+            counters["ready_hits"] += int(ready)
+            counters["wait_ms"] += (time.monotonic() - start) * 1000
+        return reply
+
+    def discard(self, entry: PrefetchEntry):
+        """Drop a prediction that turned out wrong, counting its tokens as wasted."""
+        self._count(entry.slot, "discarded")
+        if entry.future.cancel():
+            return
+
+        def count_waste(future: Future):
+            try:
+                _, tokens = future.result()
+            except BaseException:
+                return
+            with self._lock:
+                self._slot(entry.slot)["wasted_tokens"] += tokens
+
+        entry.future.add_done_callback(count_waste)
+
+    def stats(self) -> Dict[str, Dict]:
+        with self._lock:
+            snapshot = {slot: dict(counters) for slot, counters in self._counters.items()}
+        for counters in snapshot.values():
+            decided = counters["hits"] + counters["discarded"]
+            counters["hit_rate"] = counters["hits"] / decided if decided else 0.0
+            counters["avg_wait_ms"] = counters["wait_ms"] / counters["hits"] if counters["hits"] else 0.0
+        return snapshot
+
+    def _slot(self, slot: str) -> Dict:
+        return self._counters.setdefault(slot, {
+            "started": 0, "hits": 0, "ready_hits": 0, "discarded": 0, "failed": 0,
+            "wasted_tokens": 0, "wait_ms": 0.0,
+        })
+
+    def _count(self, slot: str, key: str):
+        with self._lock:
+            self._slot(slot)[key] += 1
+
+
+_prefetcher: Optional[Prefetcher] = None
+_prefetcher_lock = threading.Lock()
+
+
+def get_prefetcher() -> Prefetcher:
+    global _prefetcher
+    if _prefetcher is None:
+        with _prefetcher_lock:
+            if _prefetcher is None:
+                _prefetcher = Prefetcher()
+    return _prefetcher
@@ -0,0 +1,111 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+
+class TokenBucketLimiter:
+    """Token buckets keyed by an arbitrary string, O(1) per check.
+
+    Memory is bounded by max_keys: the least recently seen key is dropped
+    when a new one arrives. A dropped key simply starts again with a
+    full bucket.
+    """
+
+    def __init__(self, capacity: float, refill_per_second: float, max_keys: int = 10_000):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, key: str, cost: float = 1.0) -> Tuple[bool, float]:
+        """Take `cost` tokens for key. Returns (allowed, seconds until enough tokens)."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.refill_per_second)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        retry_after = 0.0 if allowed else (cost - tokens) / self.refill_per_second
+        return allowed, retry_after
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+
+class LoginRateLimiter:
+    """Per-username and per-client throttle checked before any password hashing.
+
+    Registration hashes a password too, and every attempt can use a fresh
+    username, so it has its own per-client bucket. Clients we can't
+    identify share one.
+    """
+
+    def __init__(
+        self,
+        username_limiter: Optional[TokenBucketLimiter] = None,
+        client_limiter: Optional[TokenBucketLimiter] = None,
+        registration_limiter: Optional[TokenBucketLimiter] = None,
+    ):
+        # A learner mistyping their password gets 5 quick tries, then one every 30s.
+        self.username_limiter = username_limiter or TokenBucketLimiter(capacity=5, refill_per_second=1 / 30)
+        # A shared classroom IP gets more headroom than a single account.
+        self.client_limiter = client_limiter or TokenBucketLimiter(capacity=20, refill_per_second=1 / 3)
+        # Enough for a class signing up together, then one new account every 10s.
+        self.registration_limiter = registration_limiter or TokenBucketLimiter(capacity=30, refill_per_second=1 / 10)
+        self._lock = threading.Lock()
+        self._counters = {"allowed": 0, "rejected_username": 0, "rejected_client": 0, "rejected_registration": 0}
+
+    def check(self, username: str, client: Optional[str] = None) -> Tuple[bool, float]:
+        """Returns (allowed, retry_after_seconds)."""
+        allowed, retry_after = self.client_limiter.try_acquire(client or "*")
+        if not allowed:
+            self._count("rejected_client")
+            return False, retry_after
+        allowed, retry_after = self.username_limiter.try_acquire(username.lower())
+        if not allowed:
+            self._count("rejected_username")
+            return False, retry_after
+        self._count("allowed")
+        return True, 0.0
+
+    def check_registration(self, client: Optional[str] = None) -> Tuple[bool, float]:
+        """Returns (allowed, retry_after_seconds) for creating an account."""
+        allowed, retry_after = self.registration_limiter.try_acquire(client or "*")
+        if not allowed:
+            self._count("rejected_registration")
+            return False, retry_after
+        self._count("allowed")
+        return True, 0.0
+
+    def _count(self, key: str):
+        with self._lock:
+            self._counters[key] += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            counters = dict(self._counters)
+        counters["rejected"] = (
+            counters["rejected_username"] + counters["rejected_client"] + counters["rejected_registration"]
+        )
+        counters["tracked_usernames"] = len(self.username_limiter)
+        counters["tracked_clients"] = len(self.client_limiter)
+        return counters
+
+
+_login_limiter: Optional[LoginRateLimiter] = None
+_login_limiter_lock = threading.Lock()
+
+
+def get_login_limiter() -> LoginRateLimiter:
+    global _login_limiter
+    if _login_limiter is None:
+        with _login_limiter_lock:
+            if _login_limiter is None:
+                _login_limiter = LoginRateLimiter()
+    return _login_limiter
@@ -0,0 +1,100 @@
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import db
+
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("TUTORQUEST_RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+# How many different replies to collect per prompt before serving cached ones at random.
+RESPONSE_VARIANTS = max(1, int(os.getenv("TUTORQUEST_RESPONSE_VARIANTS", "1")))
+RESPONSE_CACHE_ENTRIES = 512
+
+
+class ResponseCache:
+    """Tutor replies keyed by conversation digest, in memory and in SQLite.
+
+    The in-process LRU answers repeat lookups without touching the
+    database; the response_cache table shares replies between processes
+    and survives restarts. A key only counts as a hit once `variants`
+    replies have been collected for it, so with variants > 1 the first
+    few learners still get fresh generations and later ones get one of
+    those at random.
+    """
+
+    def __init__(self, ttl_seconds: int = RESPONSE_CACHE_TTL_SECONDS, variants: int = RESPONSE_VARIANTS,
+                 max_entries: int = RESPONSE_CACHE_ENTRIES):
+        self.ttl_seconds = ttl_seconds
+        self.variants = variants
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, List[Tuple[str, int]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0}
+
+    def get(self, key: str) -> Optional[str]:
+        cutoff = int(time.time()) - self.ttl_seconds
+        with self._lock:
+            replies = self._entries.get(key)
+            if replies is not None:
+                replies = [r for r in replies if r[1] > cutoff]
+                self._entries[key] = replies
+                self._entries.move_to_end(key)
+        tier = "memory_hits"
+        if replies is None or len(replies) < self.variants:
+            replies = db.get_cached_responses(key, self.ttl_seconds)
+            self._remember(key, replies)
+            tier = "disk_hits"
+        if len(replies) < self.variants:
+            self._count("misses")
+            return None
+        self._count(tier)
+        return random.choice(replies)[0]
+
+    def put(self, key: str, content: str):
+        with self._lock:
+            replies = list(self._entries.get(key, []))
+        if len(replies) >= self.variants:
+            return
+        created_at = int(time.time())
+        db.save_cached_response(key, len(replies), content, created_at)
+        replies.append((content, created_at))
+        self._remember(key, replies)
+        self._count("stores")
+
+    def stats(self) -> Dict:
+        with self._lock:
+            counters = dict(self._counters)
+            counters["entries"] = len(self._entries)
+        hits = counters["memory_hits"] + counters["disk_hits"]
+        lookups = hits + counters["misses"]
+        counters["hit_rate"] = hits / lookups if lookups else 0.0
+        return counters
+
+    def _remember(self, key: str, replies: List[Tuple[str, int]]):
+        if not replies:
+            return
+        with self._lock:
+            self._entries[key] = replies
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _count(self, key: str):
+        with self._lock:
+            self._counters[key] += 1
+
+
+_response_cache: Optional[ResponseCache] = None
+_response_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    global _response_cache
+    if _response_cache is None:
+        with _response_cache_lock:
+            if _response_cache is None:
+                db.purge_response_cache(RESPONSE_CACHE_TTL_SECONDS)
+                _response_cache = ResponseCache()
+    return _response_cache
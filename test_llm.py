@@ -0,0 +1,162 @@
+"""Retry, deadline and circuit-breaker behaviour of llm.call_with_retry against a scripted fake model.
+
+Run with ``python -m unittest test_llm``.
+"""
+import time
+import unittest
+
+import llm
+
+
+class FakeAPIError(Exception):
+    def __init__(self, code: int):
+        super().__init__(f"{code} from fake Gemini")
+        self.code = code
+
+
+class FakeModel:
+    """Stands in for a Gemini call, playing back a script of outcomes.
+
+    Each entry is a status code to raise, "hang" to sleep out the
+    timeout and raise TimeoutError, or anything else to return it. The
+    last entry repeats once the script runs out.
+    """
+
+    def __init__(self, *script):
+        self.script = list(script)
+        self.calls = 0
+        self.timeouts = []
+
+    def __call__(self, timeout: float):
+        outcome = self.script[min(self.calls, len(self.script) - 1)]
+        self.calls += 1
+        self.timeouts.append(timeout)
+        if outcome == "hang":
+            time.sleep(timeout)
+            raise TimeoutError("fake Gemini call timed out")
+        if isinstance(outcome, int):
+            raise FakeAPIError(outcome)
+        return outcome
+
+
+class CallWithRetryTest(unittest.TestCase):
+    def setUp(self):
+        self.sleeps = []
+
+    def call(self, model, breaker=None, **kwargs):
+        kwargs.setdefault("sleep", self.sleeps.append)
+        return llm.call_with_retry(model, breaker, **kwargs)
+
+    def test_retries_retryable_errors_until_success(self):
+        model = FakeModel(429, 503, "ok")
+        retried = []
+        self.assertEqual(self.call(model, attempts=3, on_retry=retried.append), "ok")
+        self.assertEqual(model.calls, 3)
+        self.assertEqual(len(self.sleeps), 2)
+        self.assertEqual([e.code for e in retried], [429, 503])
+
+    def test_gives_up_after_max_attempts(self):
+        model = FakeModel(503)
+        with self.assertRaises(FakeAPIError):
+            self.call(model, attempts=3)
+        self.assertEqual(model.calls, 3)
+        self.assertEqual(len(self.sleeps), 2)
+
+    def test_does_not_retry_client_errors(self):
+        breaker = llm.CircuitBreaker(failure_threshold=1)
+        model = FakeModel(400)
+        with self.assertRaises(FakeAPIError):
+            self.call(model, breaker, attempts=3)
+        self.assertEqual(model.calls, 1)
+        self.assertEqual(breaker.state, "closed")
+
+    def test_backoff_stays_within_jitter_bounds(self):
+        for attempt in range(6):
+            delay = llm.backoff_delay(attempt, base=0.5, cap=2.0)
+            self.assertGreaterEqual(delay, 0.0)
+            self.assertLessEqual(delay, min(2.0, 0.5 * 2 ** attempt))
+
+    def test_attempt_timeout_never_exceeds_configured_timeout(self):
+        model = FakeModel("hang", "hang", "ok")
+        self.assertEqual(self.call(model, timeout=0.05, deadline=5.0), "ok")
+        self.assertEqual(model.calls, 3)
+        self.assertTrue(all(t <= 0.05 for t in model.timeouts), model.timeouts)
+
+    def test_deadline_cuts_off_hanging_calls(self):
+        model = FakeModel("hang")
+        start = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            self.call(model, attempts=10, timeout=0.2, deadline=0.5)
+        elapsed = time.monotonic() - start
+        # Each attempt is capped by what's left of the deadline, so the call ends close to it.
+        self.assertLess(elapsed, 0.5 + 0.15)
+        self.assertLess(model.calls, 10)
+        self.assertTrue(all(t <= 0.2 for t in model.timeouts), model.timeouts)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self):
+        self.breaker = llm.CircuitBreaker(failure_threshold=2, cooldown_seconds=0.05)
+
+    def fail(self, model):
+        with self.assertRaises(FakeAPIError):
+            llm.call_with_retry(model, self.breaker, attempts=1)
+
+    def test_opens_after_threshold_and_fails_fast(self):
+        model = FakeModel(503)
+        self.fail(model)
+        self.assertEqual(self.breaker.state, "closed")
+        self.fail(model)
+        self.assertEqual(self.breaker.state, "open")
+        with self.assertRaises(llm.CircuitOpenError):
+            llm.call_with_retry(model, self.breaker)
+        self.assertEqual(model.calls, 2)
+        self.assertEqual(self.breaker.stats()["rejected"], 1)
+
+    def test_half_open_probe_success_closes(self):
+        model = FakeModel(503, 503, "ok")
+        self.fail(model)
+        self.fail(model)
+        time.sleep(self.breaker.cooldown_seconds)
+        self.assertEqual(self.breaker.state, "half_open")
+        self.assertEqual(llm.call_with_retry(model, self.breaker), "ok")
+        self.assertEqual(self.breaker.state, "closed")
+        self.assertEqual(model.calls, 3)
+
+    def test_half_open_probe_failure_reopens(self):
+        model = FakeModel(503)
+        self.fail(model)
+        self.fail(model)
+        time.sleep(self.breaker.cooldown_seconds)
+        self.fail(model)
+        self.assertEqual(self.breaker.state, "open")
+        self.assertEqual(self.breaker.stats()["opened"], 2)
+        with self.assertRaises(llm.CircuitOpenError):
+            llm.call_with_retry(model, self.breaker)
+        self.assertEqual(model.calls, 3)
+
+    def test_only_one_probe_while_half_open(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        time.sleep(self.breaker.cooldown_seconds)
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertTrue(self.breaker.allow())
+
+    def test_interrupted_probe_frees_the_probe_slot(self):
+        def interrupted(timeout):
+            raise KeyboardInterrupt
+
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        time.sleep(self.breaker.cooldown_seconds)
+        with self.assertRaises(KeyboardInterrupt):
+            llm.call_with_retry(interrupted, self.breaker)
+        self.assertEqual(self.breaker.state, "half_open")
+        self.assertEqual(llm.call_with_retry(FakeModel("ok"), self.breaker), "ok")
+        self.assertEqual(self.breaker.state, "closed")
+
+
+if __name__ == "__main__":
+    unittest.main()
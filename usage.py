@@ -0,0 +1,109 @@
+"""LLM usage accounting.
+
+Every Gemini call (and every reply served from the cache, a shared
+in-flight call or a prefetch) is recorded in the llm_usage table by a
+background thread. Print rollups with ``python usage.py [dimension]``,
+where dimension is one of user_id, personality, flow, kind or source.
+"""
+import atexit
+import queue
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+import db
+
+USAGE_QUEUE_SIZE = 10_000
+USAGE_BATCH_SIZE = 200
+
+
+class UsageRecorder:
+    """Non-blocking usage log: record() enqueues, a daemon thread inserts in batches.
+
+    If the queue is full the row is dropped and counted rather than
+    slowing down the learner's request.
+    """
+
+    def __init__(self, max_queue: int = USAGE_QUEUE_SIZE, batch_size: int = USAGE_BATCH_SIZE):
+        self.batch_size = batch_size
+        self._queue: "queue.Queue[Dict]" = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._counters = {"recorded": 0, "written": 0, "dropped": 0, "failures": 0}
+        self._thread = threading.Thread(target=self._run, name="tutorquest-usage", daemon=True)
+        self._thread.start()
+
+    def record(self, **row):
+        row.setdefault("created_at", int(time.time()))
+        try:
+            self._queue.put_nowait(row)
+            self._count("recorded")
+        except queue.Full:
+            self._count("dropped")
+
+    def flush(self, timeout: Optional[float] = 5.0) -> bool:
+        """Wait until everything recorded so far is written. Returns False on timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self._queue.unfinished_tasks:
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stats(self) -> Dict:
+        with self._lock:
+            counters = dict(self._counters)
+        counters["queue_depth"] = self._queue.qsize()
+        return counters
+
+    def _run(self):
+        while True:
+            rows = [self._queue.get()]
+            while len(rows) < self.batch_size:
+                try:
+                    rows.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            ok = db.save_llm_usage(rows)
+            with self._lock:
+                if ok:
+                    self._counters["written"] += len(rows)
+                else:
+                    self._counters["failures"] += 1
+            for _ in rows:
+                self._queue.task_done()
+
+    def _count(self, key: str):
+        with self._lock:
+            self._counters[key] += 1
+
+
+_recorder: Optional[UsageRecorder] = None
+_recorder_lock = threading.Lock()
+
+
+def get_usage_recorder() -> UsageRecorder:
+    global _recorder
+    if _recorder is None:
+        with _recorder_lock:
+            if _recorder is None:
+                _recorder = UsageRecorder()
+                atexit.register(_recorder.flush)
+    return _recorder
+
+
+def print_rollup(dimension: str, since: Optional[int] = None):
+    rows: List[Dict] = db.get_usage_rollup(dimension, since)
+    print(f"{dimension:>16} {'calls':>6} {'api':>5} {'fail':>5} {'avg ms':>8} {'ttft ms':>8} "
+          f"{'prompt tok':>11} {'reply tok':>10}")
+    for row in rows:
+        ttft = f"{row['avg_ttft_ms']:8.0f}" if row["avg_ttft_ms"] is not None else f"{'-':>8}"
+        print(f"{str(row['key']):>16} {row['calls']:>6} {row['api_calls']:>5} {row['failures']:>5} "
+              f"{row['avg_wall_ms']:>8.0f} {ttft} {row['prompt_tokens']:>11} {row['response_tokens']:>10}")
+
+
+if __name__ == "__main__":
+    db.init_db()
+    for name in sys.argv[1:] or ["flow", "personality", "user_id"]:
+        print_rollup(name)
+        print()